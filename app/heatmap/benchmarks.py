@@ -0,0 +1,541 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from . import geo_store
+from . import result_cache
+from .result_store import LocalResultStore, set_result_store
+from . import routes
+from .geojson_builder import build_feature_collection
+from .ingest import CHUNK_ROWS, coerce_numeric, read_upload
+from .spatial_join import PointLocator, assign_points_to_zctas
+from .zip_reference import get_zip_reference, lookup_state_codes
+
+# Zipcode Heatmap Generation Project
+# Benchmarks for the heatmap pipeline. Run from the repository root with:
+#   python -m app.heatmap.benchmarks [name ...] [--output report.json]
+# Everything runs offline: when the State-zip-code-GeoJSON files are missing,
+# synthetic per-state fixtures are generated for every zip in the reference CSV.
+
+# Upload sizes (distinct zips) for the pipeline benchmark
+PIPELINE_SIZES = tuple(
+    int(size)
+    for size in os.getenv("HEATMAP_BENCH_SIZES", "10,1000,10000,33000").split(",")
+)
+# Vertices per synthetic ZCTA polygon
+FIXTURE_VERTICES = 32
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _peak_memory(func, *args, **kwargs):
+    # Peak Python allocation while func runs, in bytes
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Geometry loading as it was done before the geometry store existed
+def _legacy_geo_load(state_codes, zip_codes):
+    filtered_new_geo_df = None
+    for state_code in state_codes:
+        entire_gdf = gpd.read_file(geo_store.state_geojson_path(state_code))
+        if filtered_new_geo_df is None:
+            filtered_new_geo_df = entire_gdf
+        else:
+            filtered_new_geo_df = pd.concat([entire_gdf, filtered_new_geo_df])
+    return filtered_new_geo_df[filtered_new_geo_df["ZCTA5CE10"].isin(zip_codes)]
+
+
+def _ring(vertices, radius):
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    return np.column_stack([np.cos(angles), np.sin(angles)]) * radius
+
+
+@contextmanager
+def synthetic_geo_fixtures(vertices=FIXTURE_VERTICES):
+    """
+    Point the geometry store at generated per-state GeoJSON holding a small
+    polygon for every zip in the reference CSV, restoring it afterwards.
+    """
+    reference = get_zip_reference()
+    ring = _ring(vertices, 0.04)
+    original_dirs = geo_store.GEO_DIR, geo_store.GEO_CACHE_DIR
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        geo_store.GEO_DIR = os.path.join(tmp_dir, "geojson")
+        geo_store.GEO_CACHE_DIR = os.path.join(tmp_dir, "geo_cache")
+        os.makedirs(geo_store.GEO_DIR)
+        for si, state_code in enumerate(geo_store.STATE_DICT):
+            zips = reference.index[reference == state_code]
+            features = []
+            for i, zip_code in enumerate(zips):
+                # Each state gets its own 5 degree block, zips on a 0.09 degree grid
+                origin = (
+                    -125 + (si % 10) * 5 + (i % 55) * 0.09,
+                    20 + (si // 10) * 5 + (i // 55) * 0.09,
+                )
+                coordinates = np.round(ring + origin, 6).tolist()
+                features.append(
+                    {
+                        "type": "Feature",
+                        "properties": {"ZCTA5CE10": f"{zip_code:05d}"},
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [coordinates + coordinates[:1]],
+                        },
+                    }
+                )
+            with open(geo_store.state_geojson_path(state_code), "w") as f:
+                json.dump({"type": "FeatureCollection", "features": features}, f)
+
+        geo_store.clear_geo_cache()
+        try:
+            yield
+        finally:
+            geo_store.GEO_DIR, geo_store.GEO_CACHE_DIR = original_dirs
+            geo_store.clear_geo_cache()
+
+
+def _available_states():
+    return [
+        code
+        for code in geo_store.STATE_DICT
+        if os.path.exists(geo_store.state_geojson_path(code))
+    ]
+
+
+@contextmanager
+def _geo_data():
+    # Real geometry when it is checked out, synthetic fixtures otherwise
+    if _available_states():
+        yield
+    else:
+        with synthetic_geo_fixtures():
+            yield
+
+
+def bench_geo_store(state_counts=(1, 5, 50), zips_per_state=200, repeat=3):
+    with _geo_data():
+        return _bench_geo_store(state_counts, zips_per_state, repeat)
+
+
+def _bench_geo_store(state_counts, zips_per_state, repeat):
+    available = _available_states()
+    if not available:
+        raise RuntimeError(f"No state GeoJSON files found in {geo_store.GEO_DIR}")
+
+    rng = random.Random(0)
+    original_cache_size = geo_store.GEO_CACHE_SIZE
+    results = []
+    try:
+        for count in state_counts:
+            state_codes = available[:count]
+            # Make sure the warm run measures cache hits rather than LRU churn
+            geo_store.GEO_CACHE_SIZE = max(original_cache_size, len(state_codes))
+
+            zip_codes = []
+            for state_code in state_codes:
+                state_zips = geo_store.get_state_geometries(state_code).index.tolist()
+                zip_codes += rng.sample(
+                    state_zips, min(zips_per_state, len(state_zips))
+                )
+
+            _, legacy = _timed(_legacy_geo_load, state_codes, zip_codes)
+
+            geo_store.clear_geo_cache()
+            _, cold = _timed(geo_store.get_zcta_geometries, state_codes, zip_codes)
+            warm = min(
+                _timed(geo_store.get_zcta_geometries, state_codes, zip_codes)[1]
+                for _ in range(repeat)
+            )
+            results.append(
+                {
+                    "states": len(state_codes),
+                    "zips": len(zip_codes),
+                    "legacy_s": round(legacy, 4),
+                    "cold_s": round(cold, 4),
+                    "warm_s": round(warm, 4),
+                }
+            )
+    finally:
+        geo_store.GEO_CACHE_SIZE = original_cache_size
+        geo_store.clear_geo_cache()
+    return results
+
+
+# Per-cell numeric conversion as the upload parser did it before coerce_numeric
+def _legacy_convert_to_number(val):
+    if isinstance(val, str):
+        val = val.replace(",", "")
+    try:
+        return float(val)
+    except ValueError:
+        return "0"
+
+
+def _legacy_coerce(df):
+    for col in df.columns[1:]:
+        df[col] = df[col].apply(lambda x: _legacy_convert_to_number(x))
+    return df
+
+
+def _vectorized_coerce(df):
+    for col in df.columns[1:]:
+        df[col] = coerce_numeric(df[col])
+    return df
+
+
+def bench_preprocess(rows=100_000, repeat=3):
+    rng = random.Random(0)
+    lines = ["Zip Code,Count,Sales,Notes"]
+    for _ in range(rows):
+        sales = f"{rng.uniform(0, 1_000_000):,.2f}"
+        notes = rng.choice(["12", "n/a", '"3,400"', ""])
+        lines.append(
+            f'{rng.randint(1000, 99950):05d},{rng.randint(0, 500)},"{sales}",{notes}'
+        )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "upload.csv")
+        with open(path, "w") as f:
+            f.write("\n".join(lines))
+
+        # Time the coercion step on its own, CSV parsing is identical in both paths
+        raw_df = pd.read_csv(path)
+        legacy = min(_timed(_legacy_coerce, raw_df.copy())[1] for _ in range(repeat))
+        vectorized = min(
+            _timed(_vectorized_coerce, raw_df.copy())[1] for _ in range(repeat)
+        )
+        with open(path, "rb") as handle:
+            _, full = _timed(read_upload, handle, path)
+
+    return {
+        "rows": rows,
+        "legacy_coerce_s": round(legacy, 4),
+        "vectorized_coerce_s": round(vectorized, 4),
+        "speedup": round(legacy / vectorized, 1),
+        "read_upload_s": round(full, 4),
+    }
+
+
+def _synthetic_zcta_frame(count, vertices=64):
+    # Roughly circular polygons on a grid, one per fake ZCTA
+    side = int(np.ceil(np.sqrt(count)))
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    ring = np.column_stack([np.cos(angles), np.sin(angles)]) * 0.04
+    geometries = [
+        shapely.Polygon(ring + (-120 + (i % side) * 0.1, 25 + (i // side) * 0.1))
+        for i in range(count)
+    ]
+    gdf = gpd.GeoDataFrame(
+        {
+            "ZCTA5CE10": [f"{i:05d}" for i in range(count)],
+            "Count": np.arange(count, dtype="float64"),
+            "Sales": np.arange(count, dtype="float64") * 10.0,
+        },
+        geometry=geometries,
+        crs="EPSG:4326",
+    )
+    gdf["color_bin"] = routes.assign_color_bins(gdf["Count"], count - 1, 0)
+    return gdf
+
+
+# KML generation as it was done with a simplekml object tree
+def _legacy_kml(geojson_data, col_name, other_cols, path):
+    import simplekml
+
+    kml = simplekml.Kml()
+    for feature in geojson_data["features"]:
+        poly = kml.newpolygon(name=feature["properties"]["ZCTA5CE10"])
+        poly.description = (
+            f"{col_name}: {feature['properties'][col_name]}\n"
+            + "\n".join(f"{name}: {feature['properties'][name]}" for name in other_cols)
+        )
+        poly.outerboundaryis = [
+            (lon, lat) for lon, lat in feature["geometry"]["coordinates"][0]
+        ]
+        poly.style.polystyle.color = routes.KML_COLOR_BINS[
+            feature["properties"]["color_bin"]
+        ]
+        poly.style.polystyle.outline = 3
+    kml.save(path)
+
+
+def bench_kml(counts=(1_000, 33_000)):
+    results = []
+    original_dir = routes.HEATMAP_DIR
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        routes.HEATMAP_DIR = tmp_dir
+        try:
+            for count in counts:
+                gdf = _synthetic_zcta_frame(count)
+                geojson_data = json.loads(gdf.to_json())
+                _, legacy = _timed(
+                    _legacy_kml,
+                    geojson_data,
+                    "Count",
+                    ["Sales"],
+                    os.path.join(tmp_dir, "legacy.kml"),
+                )
+                _, streaming = _timed(
+                    routes.generate_kml, gdf, "Count", ["Sales"], "bench"
+                )
+                results.append(
+                    {
+                        "polygons": count,
+                        "simplekml_s": round(legacy, 4),
+                        "streaming_s": round(streaming, 4),
+                        "speedup": round(legacy / streaming, 1),
+                    }
+                )
+        finally:
+            routes.HEATMAP_DIR = original_dir
+    return results
+
+
+# GeoJSON mapping as it was built before build_feature_collection
+def _legacy_feature_collection(geo_df):
+    return json.loads(geo_df.to_json())
+
+
+def bench_geojson(count=2_000, repeat=3):
+    gdf = _synthetic_zcta_frame(count)
+    gdf["fill_color"] = routes.COLOR_BINS[gdf["color_bin"]]
+
+    legacy = min(_timed(_legacy_feature_collection, gdf)[1] for _ in range(repeat))
+    direct = min(_timed(build_feature_collection, gdf)[1] for _ in range(repeat))
+    return {
+        "polygons": count,
+        "to_json_loads_s": round(legacy, 4),
+        "feature_builder_s": round(direct, 4),
+        "speedup": round(legacy / direct, 1),
+        "to_json_loads_peak_mb": round(
+            _peak_memory(_legacy_feature_collection, gdf) / 1024**2, 1
+        ),
+        "feature_builder_peak_mb": round(
+            _peak_memory(build_feature_collection, gdf) / 1024**2, 1
+        ),
+    }
+
+
+def _pipeline_zips(count, spread, rng):
+    reference = get_zip_reference()
+    if spread == "single":
+        # The state with the most zips, so single-state runs cover the most sizes
+        state_code = reference.value_counts().idxmax()
+        candidates = reference.index[reference == state_code]
+    else:
+        candidates = reference.index[reference.isin(list(geo_store.STATE_DICT))]
+    if count > len(candidates):
+        return None
+    return [f"{zip_code:05d}" for zip_code in rng.sample(list(candidates), count)]
+
+
+def _write_upload(path, zip_codes, rng):
+    df = pd.DataFrame(
+        {
+            "Zip Code": zip_codes,
+            "Count": [rng.randint(1, 500) for _ in zip_codes],
+            "Sales": [f"{rng.uniform(0, 1_000_000):,.2f}" for _ in zip_codes],
+        }
+    )
+    if path.endswith(".xlsx"):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def _merge_upload(input_df):
+    # The zip lookup, geometry filter and merge steps of build_heatmap
+    state_codes = lookup_state_codes(input_df["Zip Code"])
+    geo_df = geo_store.get_zcta_geometries(
+        state_codes.dropna().unique().tolist(), input_df["Zip Code"]
+    )
+    merged = pd.merge(
+        geo_df, input_df, left_on="ZCTA5CE10", right_on="Zip Code", how="left"
+    ).fillna(0)
+    merged["color_bin"] = routes.assign_color_bins(
+        merged["Count"], input_df["Count"].max(), input_df["Count"].min()
+    )
+    return merged
+
+
+def _pipeline_client():
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.register_blueprint(routes.heatmap_bp, url_prefix="/heatmap")
+    return app.test_client()
+
+
+def _post_upload(client, path):
+    with open(path, "rb") as f:
+        return client.post(
+            "/heatmap/zipcode",
+            data={
+                "excel_file": (f, os.path.basename(path)),
+                "zip_col": "0",
+                "main_col": "1",
+                "sec_col": "2",
+                "city": "bench",
+            },
+            content_type="multipart/form-data",
+        )
+
+
+def bench_pipeline(
+    sizes=PIPELINE_SIZES, spreads=("single", "multi"), formats=("csv", "xlsx")
+):
+    """
+    Time upload parsing, the merge/filter steps, KML generation and the full
+    /heatmap/zipcode request for synthetic uploads of each size, spread and format.
+    """
+    rng = random.Random(0)
+    client = _pipeline_client()
+    original_dirs = (
+        routes.HEATMAP_DIR,
+        routes.DATA_DIR,
+        result_cache.RESULT_DIR,
+        result_cache.CACHE_INDEX_PATH,
+    )
+    results = []
+    with _geo_data(), tempfile.TemporaryDirectory() as tmp_dir:
+        # Results and uploads go to the temp dir, and the result cache starts empty
+        routes.HEATMAP_DIR = result_cache.RESULT_DIR = os.path.join(tmp_dir, "result")
+        routes.DATA_DIR = os.path.join(tmp_dir, "data")
+        result_cache.CACHE_INDEX_PATH = os.path.join(
+            tmp_dir, "result", ".cache_index.json"
+        )
+        os.makedirs(routes.HEATMAP_DIR)
+        os.makedirs(routes.DATA_DIR)
+        original_store = set_result_store(LocalResultStore(routes.HEATMAP_DIR))
+        try:
+            for size in sizes:
+                for spread in spreads:
+                    zip_codes = _pipeline_zips(size, spread, rng)
+                    if zip_codes is None:
+                        results.append(
+                            {"zips": size, "spread": spread, "skipped": True}
+                        )
+                        continue
+                    for upload_format in formats:
+                        path = os.path.join(
+                            tmp_dir, f"upload_{size}_{spread}.{upload_format}"
+                        )
+                        _write_upload(path, zip_codes, rng)
+
+                        with open(path, "rb") as handle:
+                            (input_df, _), parse = _timed(read_upload, handle, path)
+                        merged, merge = _timed(_merge_upload, input_df)
+                        _, kml = _timed(
+                            routes.generate_kml, merged, "Count", ["Sales"], "bench"
+                        )
+                        response, request_time = _timed(_post_upload, client, path)
+
+                        results.append(
+                            {
+                                "zips": size,
+                                "spread": spread,
+                                "format": upload_format,
+                                "read_upload_s": round(parse, 4),
+                                "merge_s": round(merge, 4),
+                                "generate_kml_s": round(kml, 4),
+                                "request_s": round(request_time, 4),
+                                "status": response.status_code,
+                            }
+                        )
+        finally:
+            (
+                routes.HEATMAP_DIR,
+                routes.DATA_DIR,
+                result_cache.RESULT_DIR,
+                result_cache.CACHE_INDEX_PATH,
+            ) = original_dirs
+            set_result_store(original_store)
+    return results
+
+
+def bench_spatial_join(points=1_000_000):
+    with _geo_data():
+        bounds = geo_store.state_bounds()
+        # Uniform points inside randomly chosen state bounding boxes
+        rng = np.random.default_rng(0)
+        boxes = np.array(list(bounds.values()))[rng.integers(len(bounds), size=points)]
+        longitudes = rng.uniform(boxes[:, 0], boxes[:, 2])
+        latitudes = rng.uniform(boxes[:, 1], boxes[:, 3])
+
+        # One call with every point, then the same points in upload-sized
+        # chunks through one locator the way read_upload does
+        zctas, single = _timed(assign_points_to_zctas, longitudes, latitudes)
+
+        def chunked():
+            locator = PointLocator()
+            for start in range(0, points, CHUNK_ROWS):
+                stop = start + CHUNK_ROWS
+                locator.locate(longitudes[start:stop], latitudes[start:stop])
+
+        _, chunked_s = _timed(chunked)
+    return {
+        "points": points,
+        "states": len(bounds),
+        "matched": int(pd.notna(zctas).sum()),
+        "single_call_s": round(single, 4),
+        "chunked_s": round(chunked_s, 4),
+        "chunk_rows": CHUNK_ROWS,
+    }
+
+
+BENCHMARKS = {
+    "geo_store": bench_geo_store,
+    "preprocess": bench_preprocess,
+    "kml": bench_kml,
+    "geojson": bench_geojson,
+    "pipeline": bench_pipeline,
+    "spatial_join": bench_spatial_join,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Heatmap pipeline benchmarks")
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+        "geopandas": gpd.__version__,
+    }
+    for name in args.names:
+        print(f"Running {name}...", file=sys.stderr)
+        report[name] = BENCHMARKS[name]()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# Zipcode Heatmap Generation Project
+# ZCTA geometry store: per-state GeoJSON is parsed once, converted to a compact
+# pickled GeoDataFrame indexed by ZCTA5CE10 and kept in a bounded LRU cache so a
+# request only slices out the polygons it needs.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GEO_DIR = os.getenv("HEATMAP_GEO_DIR", os.path.join(BASE_DIR, "State-zip-code-GeoJSON"))
+GEO_CACHE_DIR = os.getenv(
+    "HEATMAP_GEO_CACHE_DIR", os.path.join(BASE_DIR, "heatmap/geo_cache")
+)
+# Maximum number of (state, detail tier) entries held in memory at once
+GEO_CACHE_SIZE = int(os.getenv("HEATMAP_GEO_CACHE_SIZE", "12"))
+# Comma separated state codes (or "all") to load when the blueprint is imported.
+# GEO_CACHE_SIZE is raised to fit them if it is smaller.
+GEO_PRELOAD = os.getenv("HEATMAP_GEO_PRELOAD", "")
+
+ZCTA_KEY = "ZCTA5CE10"
+
+# Geometry detail tiers: topology-preserving simplify tolerance (degrees) and the
+# number of decimals coordinates are rounded to. "full" is the source geometry.
+DETAIL_TIERS = {
+    "full": {"tolerance": None, "precision": None},
+    "high": {"tolerance": 0.0001, "precision": 6},
+    "medium": {"tolerance": 0.0005, "precision": 5},
+    "low": {"tolerance": 0.002, "precision": 4},
+}
+
+STATE_DICT = {
+    "AL": "alabama",
+    "AK": "alaska",
+    "AZ": "arizona",
+    "AR": "arkansas",
+    "CA": "california",
+    "CO": "colorado",
+    "CT": "connecticut",
+    "DE": "delaware",
+    "FL": "florida",
+    "GA": "georgia",
+    "HI": "hawaii",
+    "ID": "idaho",
+    "IL": "illinois",
+    "IN": "indiana",
+    "IA": "iowa",
+    "KS": "kansas",
+    "KY": "kentucky",
+    "LA": "louisiana",
+    "ME": "maine",
+    "MD": "maryland",
+    "MA": "massachusetts",
+    "MI": "michigan",
+    "MN": "minnesota",
+    "MS": "mississippi",
+    "MO": "missouri",
+    "MT": "montana",
+    "NE": "nebraska",
+    "NV": "nevada",
+    "NH": "new hampshire",
+    "NJ": "new jersey",
+    "NM": "new mexico",
+    "NY": "new york",
+    "NC": "north carolina",
+    "ND": "north dakota",
+    "OH": "ohio",
+    "OK": "oklahoma",
+    "OR": "oregon",
+    "PA": "pennsylvania",
+    "RI": "rhode island",
+    "SC": "south carolina",
+    "SD": "south dakota",
+    "TN": "tennessee",
+    "TX": "texas",
+    "UT": "utah",
+    "VT": "vermont",
+    "VA": "virginia",
+    "WA": "washington",
+    "WV": "west virginia",
+    "WI": "wisconsin",
+    "WY": "wyoming",
+}
+
+_state_cache = OrderedDict()
+_state_lock = threading.Lock()
+# Spatial indexes, evicted together with the state they were built from
+_index_cache = {}
+
+
+def state_geojson_path(state_code):
+    """Return the source GeoJSON path for a state code, or None if unknown."""
+    state_name = STATE_DICT.get(state_code)
+    if state_name is None:
+        return None
+    return os.path.join(
+        GEO_DIR, f"{state_code.lower()}_{state_name}_zip_codes_geo.min.json"
+    )
+
+
+def _cache_path(state_code, detail="full"):
+    suffix = "" if detail == "full" else f"_{detail}"
+    return os.path.join(GEO_CACHE_DIR, f"{state_code.lower()}_zcta{suffix}.pkl")
+
+
+def simplify_geometries(geometries, tolerance, precision):
+    """Simplify polygons without breaking their topology and round coordinates."""
+    simplified = shapely.simplify(
+        np.asarray(geometries), tolerance, preserve_topology=True
+    )
+    return shapely.transform(simplified, lambda coords: np.round(coords, precision))
+
+
+def _read_state(state_code, detail="full"):
+    """Load one state's ZCTA polygons, rebuilding the on-disk cache if stale."""
+    source_path = state_geojson_path(state_code)
+    cache_path = _cache_path(state_code, detail)
+
+    if os.path.exists(cache_path) and os.path.getmtime(
+        cache_path
+    ) >= os.path.getmtime(source_path):
+        return pd.read_pickle(cache_path)
+
+    if detail == "full":
+        gdf = gpd.read_file(source_path)[[ZCTA_KEY, "geometry"]]
+        gdf[ZCTA_KEY] = gdf[ZCTA_KEY].astype(str)
+        gdf = gdf.set_index(ZCTA_KEY, drop=False).sort_index()
+    else:
+        tier = DETAIL_TIERS[detail]
+        gdf = get_state_geometries(state_code).copy()
+        gdf["geometry"] = simplify_geometries(
+            gdf.geometry.values, tier["tolerance"], tier["precision"]
+        )
+
+    # Write to a temporary file first so concurrent readers never see a partial pickle
+    os.makedirs(GEO_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    gdf.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return gdf
+
+
+def get_state_geometries(state_code, detail="full"):
+    """Return the indexed GeoDataFrame for a state and detail tier, loading on first use."""
+    key = (state_code, detail)
+    with _state_lock:
+        if key in _state_cache:
+            _state_cache.move_to_end(key)
+            return _state_cache[key]
+
+    gdf = _read_state(state_code, detail)
+
+    with _state_lock:
+        _state_cache[key] = gdf
+        _state_cache.move_to_end(key)
+        while len(_state_cache) > GEO_CACHE_SIZE:
+            evicted, _ = _state_cache.popitem(last=False)
+            _index_cache.pop(evicted, None)
+    return gdf
+
+
+def get_state_index(state_code, detail="full"):
+    """Return an STRtree over a state's polygons and the ZCTA of each tree item."""
+    key = (state_code, detail)
+    gdf = get_state_geometries(state_code, detail)
+    with _state_lock:
+        entry = _index_cache.get(key)
+        if entry is not None and entry[0] is gdf:
+            return entry[1], entry[2]
+
+    tree = shapely.STRtree(gdf.geometry.values)
+    zctas = gdf[ZCTA_KEY].to_numpy()
+    with _state_lock:
+        _index_cache[key] = (gdf, tree, zctas)
+    return tree, zctas
+
+
+def _bounds_path():
+    return os.path.join(GEO_CACHE_DIR, "state_bounds.json")
+
+
+def state_bounds():
+    """
+    Return {state_code: (minx, miny, maxx, maxy)} for every state with geometry.
+    Bounds are kept on disk and only recomputed for states whose source changed.
+    """
+    try:
+        with open(_bounds_path()) as f:
+            stored = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        stored = {}
+
+    bounds = {}
+    changed = False
+    for state_code in STATE_DICT:
+        source_path = state_geojson_path(state_code)
+        if not os.path.exists(source_path):
+            continue
+        mtime = os.path.getmtime(source_path)
+        entry = stored.get(state_code)
+        if entry is None or entry["mtime"] != mtime:
+            total_bounds = get_state_geometries(state_code).total_bounds
+            entry = {"mtime": mtime, "bounds": [float(v) for v in total_bounds]}
+            changed = True
+        stored[state_code] = entry
+        bounds[state_code] = tuple(entry["bounds"])
+
+    if changed:
+        os.makedirs(GEO_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{_bounds_path()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, _bounds_path())
+
+    return bounds
+
+
+def get_zcta_geometries(state_codes, zip_codes, detail="full"):
+    """Return only the polygons for zip_codes from the given states."""
+    wanted = pd.Index(pd.unique(pd.Series(zip_codes, dtype=str)))
+    frames = []
+    for state_code in state_codes:
+        source_path = state_geojson_path(state_code)
+        if source_path is None or not os.path.exists(source_path):
+            print(f"No ZCTA geometry available for state: {state_code}")
+            continue
+
+        state_gdf = get_state_geometries(state_code, detail)
+        matches = state_gdf.index.intersection(wanted)
+        if len(matches):
+            frames.append(state_gdf.loc[matches])
+
+    if not frames:
+        return gpd.GeoDataFrame(
+            {ZCTA_KEY: pd.Series(dtype=str)}, geometry=gpd.GeoSeries(), crs="EPSG:4326"
+        )
+    return gpd.GeoDataFrame(pd.concat(frames).reset_index(drop=True))
+
+
+def preload_states(state_codes):
+    """Warm the cache for the given state codes."""
+    for state_code in state_codes:
+        source_path = state_geojson_path(state_code)
+        if source_path is not None and os.path.exists(source_path):
+            get_state_geometries(state_code)
+
+
+def clear_geo_cache():
+    """Drop every state held in memory (the on-disk cache is kept)."""
+    with _state_lock:
+        _state_cache.clear()
+        _index_cache.clear()
+
+
+def cached_states():
+    with _state_lock:
+        return [state_code for state_code, _ in _state_cache.keys()]
+
+
+if GEO_PRELOAD:
+    if GEO_PRELOAD.strip().lower() == "all":
+        preload_codes = list(STATE_DICT.keys())
+    else:
+        preload_codes = [code.strip().upper() for code in GEO_PRELOAD.split(",")]
+    # Preloaded states stay resident, the cache grows to hold all of them
+    if len(preload_codes) > GEO_CACHE_SIZE:
+        print(
+            f"HEATMAP_GEO_CACHE_SIZE raised from {GEO_CACHE_SIZE} to "
+            f"{len(preload_codes)} to hold the preloaded states"
+        )
+        GEO_CACHE_SIZE = len(preload_codes)
+    preload_states(preload_codes)
@@ -0,0 +1,28 @@
+import shapely
+
+# Zipcode Heatmap Generation Project
+# Builds the GeoJSON mapping for the map layers straight from the shapely
+# geometries and column values, instead of serializing the GeoDataFrame with
+# to_json and parsing the string back with json.loads.
+
+
+# Zipcode Heatmap Generation Project
+def build_feature_collection(geo_df):
+    """Return geo_df as a GeoJSON FeatureCollection dict, one feature per row."""
+    geometries = [
+        shapely.geometry.mapping(geometry) for geometry in geo_df.geometry.values
+    ]
+    # to_dict returns Python scalars, so the properties serialize as they are
+    properties = geo_df.drop(columns=geo_df.geometry.name).to_dict("records")
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "id": str(index),
+                "type": "Feature",
+                "properties": props,
+                "geometry": geometry,
+            }
+            for index, props, geometry in zip(geo_df.index, properties, geometries)
+        ],
+    }
@@ -0,0 +1,217 @@
+import os
+from itertools import islice
+
+import pandas as pd
+
+from .spatial_join import PointLocator
+
+# Zipcode Heatmap Generation Project
+# Chunked upload ingest. Spreadsheets are read a block of rows at a time and
+# each block is reduced to one row per zip before the next is read, so memory
+# is bounded by the number of distinct zips rather than the number of rows.
+CHUNK_ROWS = int(os.getenv("HEATMAP_CHUNK_ROWS", "100000"))
+
+# How duplicate rows for a zip are combined, and the per zip statistics each
+# mode keeps while reading. Every statistic can be merged across chunks.
+AGG_MODES = ("sum", "mean", "count", "max")
+AGG_STATISTICS = {
+    "sum": ["sum"],
+    "mean": ["sum", "count"],
+    "count": ["count"],
+    "max": ["max"],
+}
+# min_count keeps zips whose cells are all empty as NaN rather than 0
+CHUNK_REDUCERS = {
+    "sum": lambda grouped: grouped.sum(min_count=1),
+    "count": lambda grouped: grouped.count(),
+    "max": lambda grouped: grouped.max(),
+}
+COMBINE_REDUCERS = {
+    "sum": lambda grouped: grouped.sum(min_count=1),
+    "count": lambda grouped: grouped.sum(),
+    "max": lambda grouped: grouped.max(),
+}
+
+# Columns appended to lat/lon uploads: a 1 per point, so sum gives the number of
+# points per ZCTA, and the ZCTA each point fell in
+POINT_COUNT_COLUMN = "Points"
+MATCHED_ZIP_COLUMN = "Matched ZCTA"
+
+
+class UploadError(ValueError):
+    """An upload that can't be read, reported back to the client as a 400."""
+
+
+# Zipcode Heatmap Generation Project
+def coerce_numeric(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype("float64")
+
+    # Strip thousands separators before parsing, e.g. "1,234.50"
+    text = series.astype(str).str.replace(",", "", regex=False).str.strip()
+    try:
+        # Fast path for columns that are entirely numeric once cleaned
+        numbers = text.astype("float64")
+    except ValueError:
+        numbers = pd.to_numeric(text, errors="coerce")
+
+    # Values that can't be parsed count as 0, empty cells stay empty
+    return numbers.mask(numbers.isna() & series.notna(), 0.0).astype("float64")
+
+
+# Zipcode Heatmap Generation Project
+def parse_zip_codes(series):
+    # Zips read as numbers lose their leading zeros, e.g. 1234 -> "01234"
+    text = series.astype(str).str.zfill(5)
+    return text.str.extract(r"(\d{5})", expand=False)
+
+
+# Zipcode Heatmap Generation Project
+def iter_csv_chunks(handle):
+    yield from pd.read_csv(handle, chunksize=CHUNK_ROWS)
+
+
+# Zipcode Heatmap Generation Project
+def dedupe_columns(names):
+    """Rename repeated header names the way pandas does, e.g. Sales, Sales.1."""
+    columns = []
+    seen = set(names)
+    counts = {}
+    for name in names:
+        if name in counts:
+            # Skip suffixes that would collide with another header
+            while True:
+                counts[name] += 1
+                candidate = f"{name}.{counts[name]}"
+                if candidate not in seen:
+                    break
+            seen.add(candidate)
+            columns.append(candidate)
+        else:
+            counts[name] = 0
+            columns.append(name)
+    return columns
+
+
+# Zipcode Heatmap Generation Project
+def iter_xlsx_chunks(handle):
+    import openpyxl
+
+    # Read-only mode streams rows from the sheet XML instead of building the workbook
+    workbook = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+    try:
+        # Like pd.read_excel, read the first sheet rather than the selected one
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = dedupe_columns(
+            [
+                name if name is not None else f"Unnamed: {i}"
+                for i, name in enumerate(header)
+            ]
+        )
+        while True:
+            block = list(islice(rows, CHUNK_ROWS))
+            if not block:
+                break
+            yield pd.DataFrame(block, columns=columns).infer_objects()
+    finally:
+        workbook.close()
+
+
+# Zipcode Heatmap Generation Project
+def locate_chunk(chunk, lat_col, lon_col, locator):
+    """Append the point count and matched ZCTA columns to a chunk of lat/lon rows."""
+    zctas = locator.locate(
+        coerce_numeric(chunk.iloc[:, lon_col]).to_numpy(),
+        coerce_numeric(chunk.iloc[:, lat_col]).to_numpy(),
+    )
+    return chunk.assign(**{POINT_COUNT_COLUMN: 1.0, MATCHED_ZIP_COLUMN: zctas})
+
+
+# Zipcode Heatmap Generation Project
+def reduce_chunk(chunk, zip_name, statistics):
+    """Coerce a chunk's value columns and compute statistics per parsed zip."""
+    values = {
+        col: coerce_numeric(chunk[col]) for col in chunk.columns if col != zip_name
+    }
+    frame = pd.DataFrame(values, index=chunk.index)
+    frame[zip_name] = parse_zip_codes(chunk[zip_name])
+    # Rows without a 5 digit zip can never be mapped
+    frame = frame.dropna(subset=[zip_name])
+    grouped = frame.groupby(zip_name, sort=False)
+    return pd.concat(
+        {stat: CHUNK_REDUCERS[stat](grouped) for stat in statistics}, axis=1
+    )
+
+
+# Zipcode Heatmap Generation Project
+def combine_partials(partials, statistics):
+    return pd.concat(
+        {
+            stat: COMBINE_REDUCERS[stat](partials[stat].groupby(level=0, sort=False))
+            for stat in statistics
+        },
+        axis=1,
+    )
+
+
+# Zipcode Heatmap Generation Project
+def finalize_statistics(totals, agg):
+    if agg == "mean":
+        # Zips with no values in a column divide 0 by 0 and stay empty
+        return totals["sum"] / totals["count"].replace(0, float("nan"))
+    return totals[agg].astype("float64")
+
+
+# Zipcode Heatmap Generation Project
+def read_upload(handle, filename, zip_col=0, agg="sum", point_cols=None):
+    """
+    Read an uploaded CSV or xlsx in chunks, one row per zip code with duplicate
+    rows combined by agg. Returns the aggregated frame in the upload's column
+    order, with the zip column holding parsed 5 digit zips, and the upload's
+    column dtypes.
+
+    With point_cols=(lat_col, lon_col) rows are placed in the ZCTA containing
+    their point instead, and the frame ends with the POINT_COUNT_COLUMN and
+    MATCHED_ZIP_COLUMN columns.
+    """
+    if agg not in AGG_MODES:
+        raise UploadError(f"Unsupported aggregation {agg}")
+    statistics = AGG_STATISTICS[agg]
+
+    if filename.endswith(".xlsx"):
+        chunks = iter_xlsx_chunks(handle)
+    elif filename.endswith(".csv"):
+        chunks = iter_csv_chunks(handle)
+    else:
+        raise UploadError("Unsupported file format")
+
+    # One locator per upload, so state indexes are built once for all chunks
+    locator = PointLocator() if point_cols is not None else None
+
+    columns = None
+    dtypes = None
+    totals = None
+    for chunk in chunks:
+        if point_cols is not None:
+            chunk = locate_chunk(chunk, *point_cols, locator)
+        if columns is None:
+            columns = chunk.columns.tolist()
+            zip_name = MATCHED_ZIP_COLUMN if point_cols is not None else columns[zip_col]
+            dtypes = {
+                str(col): "float64" if col != zip_name else str(dtype)
+                for col, dtype in chunk.dtypes.items()
+            }
+        partial = reduce_chunk(chunk, zip_name, statistics)
+        totals = (
+            partial
+            if totals is None
+            else combine_partials(pd.concat([totals, partial]), statistics)
+        )
+
+    if columns is None:
+        raise UploadError("Uploaded file has no rows")
+
+    return finalize_statistics(totals, agg).reset_index()[columns], dtypes
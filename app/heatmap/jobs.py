@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import uuid
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Zipcode Heatmap Generation Project
+# Background job runner for heatmaps. CPU-heavy work runs in a process pool so
+# the web worker stays responsive; job state lives in small JSON files so any
+# web worker (and the pool processes themselves) can read and update it.
+JOBS_DIR = os.getenv(
+    "HEATMAP_JOBS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "heatmap/jobs"),
+)
+# Number of heatmaps rendered at the same time
+JOB_WORKERS = int(os.getenv("HEATMAP_JOB_WORKERS", "2"))
+# Jobs accepted (queued + running) before new submissions are rejected
+JOB_MAX_PENDING = int(os.getenv("HEATMAP_JOB_MAX_PENDING", "20"))
+# Seconds a job's status file is kept after its last update
+JOB_TTL = int(os.getenv("HEATMAP_JOB_TTL", str(24 * 3600)))
+
+_executor = None
+_pending = 0
+_jobs_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def read_job_status(job_id):
+    """Return the stored status dict for a job, or None if it doesn't exist."""
+    # Job ids are uuid hex strings, anything else can't name a job file
+    if not job_id.isalnum():
+        return None
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_job_status(job_id, **fields):
+    """Merge fields into the job's status file, replacing it atomically."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    status = read_job_status(job_id) or {"job_id": job_id}
+    status.update(fields, updated_at=time.time())
+
+    tmp_path = f"{_job_path(job_id)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, _job_path(job_id))
+    return status
+
+
+def sweep_jobs(now=None):
+    """Delete status files not updated within JOB_TTL. Returns the number removed."""
+    if not os.path.isdir(JOBS_DIR):
+        return 0
+    now = now or time.time()
+    removed = 0
+    for entry in os.scandir(JOBS_DIR):
+        # Covers leftover .tmp files from interrupted writes too
+        try:
+            if now - entry.stat().st_mtime < JOB_TTL:
+                continue
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            # Replaced or removed by another process since the scan
+            pass
+    return removed
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn starts clean interpreters rather than forking the eventlet-patched
+        # parent. They re-run the entry script as __mp_main__, which run.py
+        # checks to skip monkey_patch() and create_app().
+        _executor = ProcessPoolExecutor(
+            max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _executor
+
+
+def _job_finished(job_id, on_result, future):
+    global _pending
+    with _jobs_lock:
+        _pending -= 1
+
+    # The job function records its own failures; this catches crashed workers
+    error = future.exception()
+    if error is not None:
+        write_job_status(job_id, status="failed", error=str(error))
+    elif on_result is not None:
+        on_result(future.result())
+
+
+def submit_job(job_id, func, *args, on_result=None):
+    """
+    Queue func(job_id, *args) on the process pool. on_result is called in this
+    process with the function's return value once it finishes.
+    """
+    global _pending
+    with _jobs_lock:
+        if _pending >= JOB_MAX_PENDING:
+            raise JobQueueFull(f"{_pending} heatmap jobs are already pending")
+        _pending += 1
+
+    write_job_status(job_id, status="queued", progress=0.0, submitted_at=time.time())
+    try:
+        future = _get_executor().submit(func, job_id, *args)
+    except Exception:
+        with _jobs_lock:
+            _pending -= 1
+        raise
+    future.add_done_callback(partial(_job_finished, job_id, on_result))
+    return job_id
@@ -0,0 +1,118 @@
+import io
+import zipfile
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+import numpy as np
+import shapely
+
+# Zipcode Heatmap Generation Project
+# Streaming KML writer. Styles are written once per color bin and placemarks are
+# written straight to the file handle in batches, so memory does not grow with
+# the number of polygons the way a simplekml object tree does.
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+    "<Document>\n"
+)
+KML_FOOTER = "</Document>\n</kml>\n"
+
+# Number of features converted to text per batch
+BATCH_SIZE = 500
+
+
+@contextmanager
+def open_kml_stream(path, kmz=False):
+    """Yield a text handle for a .kml file, or for doc.kml inside a .kmz archive."""
+    if not kmz:
+        with open(path, "w", encoding="utf-8") as handle:
+            yield handle
+        return
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("doc.kml", "w") as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8") as handle:
+                yield handle
+
+
+def package_kmz(kml_path):
+    """Write a .kmz archive holding kml_path as doc.kml beside it and return its path."""
+    kmz_path = kml_path.rsplit(".", 1)[0] + ".kmz"
+    with zipfile.ZipFile(kmz_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.write(kml_path, "doc.kml")
+    return kmz_path
+
+
+def escape_series(series):
+    """XML-escape every value of a string Series."""
+    return (
+        series.astype(str)
+        .str.replace("&", "&amp;", regex=False)
+        .str.replace("<", "&lt;", regex=False)
+        .str.replace(">", "&gt;", regex=False)
+    )
+
+
+def format_ring(coords):
+    return " ".join(f"{x},{y}" for x, y in coords.tolist())
+
+
+class KMLWriter:
+    """Write a KML document incrementally to an open text handle."""
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def start(self, colors, name=None):
+        self.handle.write(KML_HEADER)
+        if name is not None:
+            self.handle.write(f"<name>{escape(str(name))}</name>\n")
+        for i, color in enumerate(colors):
+            self.handle.write(
+                f'<Style id="bin{i}"><PolyStyle><color>{color}</color>'
+                "<outline>1</outline></PolyStyle></Style>\n"
+            )
+
+    def open_folder(self, name, visible=True):
+        self.handle.write(
+            f"<Folder><name>{escape(str(name))}</name>"
+            f"<visibility>{int(visible)}</visibility>\n"
+        )
+
+    def close_folder(self):
+        self.handle.write("</Folder>\n")
+
+    def end(self):
+        self.handle.write(KML_FOOTER)
+
+    def write_placemarks(self, names, descriptions, geometries, color_bins):
+        """
+        Write one Placemark per polygon part. Names and descriptions must already
+        be XML-escaped; MultiPolygons are split into their parts and only the
+        outer boundary of each part is written.
+        """
+        names = np.asarray(names, dtype=object)
+        descriptions = np.asarray(descriptions, dtype=object)
+        geometries = np.asarray(geometries, dtype=object)
+        color_bins = np.asarray(color_bins)
+
+        for start in range(0, len(geometries), BATCH_SIZE):
+            stop = start + BATCH_SIZE
+            parts, feature_index = shapely.get_parts(
+                geometries[start:stop], return_index=True
+            )
+            rings = shapely.get_exterior_ring(parts)
+            coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+            ring_coords = np.split(coords, np.flatnonzero(np.diff(ring_index)) + 1)
+
+            for i, coords in zip(np.unique(ring_index), ring_coords):
+                feature = start + feature_index[i]
+                self.handle.write(
+                    f"<Placemark><name>{names[feature]}</name>"
+                    f"<description>{descriptions[feature]}</description>"
+                    f"<styleUrl>#bin{color_bins[feature]}</styleUrl>"
+                    "<Polygon><outerBoundaryIs><LinearRing><coordinates>"
+                    f"{format_ring(coords)}"
+                    "</coordinates></LinearRing></outerBoundaryIs></Polygon>"
+                    "</Placemark>\n"
+                )
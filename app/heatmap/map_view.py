@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import shapely
+
+# Zipcode Heatmap Generation Project
+# Start location for the folium map. The map is always fit to the data bounds,
+# so the location only matters until that happens and is picked without
+# dissolving the polygons.
+
+
+# Zipcode Heatmap Generation Project
+def bounds_center(geo_df):
+    minx, miny, maxx, maxy = geo_df.total_bounds
+    return [(miny + maxy) / 2, (minx + maxx) / 2]
+
+
+# Zipcode Heatmap Generation Project
+def weighted_centroid(geo_df):
+    # Same point as the centroid of the union for non-overlapping polygons
+    geometries = geo_df.geometry.values
+    areas = shapely.area(geometries)
+    if not areas.sum():
+        return bounds_center(geo_df)
+    coords = shapely.get_coordinates(shapely.centroid(geometries))
+    longitude, latitude = np.average(coords, axis=0, weights=areas)
+    return [latitude, longitude]
+
+
+VIEW_STRATEGIES = {
+    "bounds": bounds_center,
+    "centroid": weighted_centroid,
+}
+DEFAULT_VIEW_STRATEGY = os.getenv("HEATMAP_VIEW_STRATEGY", "bounds")
+
+
+# Zipcode Heatmap Generation Project
+def map_view(geo_df, strategy=None):
+    """Return the map start location [lat, lon] and the [[S, W], [N, E]] bounds to fit."""
+    minx, miny, maxx, maxy = geo_df.total_bounds
+    location = VIEW_STRATEGIES[strategy or DEFAULT_VIEW_STRATEGY](geo_df)
+    return location, [[miny, minx], [maxy, maxx]]
@@ -0,0 +1,161 @@
+import io
+import os
+import time
+import pstats
+import cProfile
+import threading
+from collections import deque
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    from eventlet import patcher as eventlet_patcher
+except ImportError:  # Only needed when the server runs under eventlet
+    eventlet_patcher = None
+
+from .stage_timer import HEATMAP_STAGES
+
+# Zipcode Heatmap Generation Project
+# Rolling per-stage timings and peak memory for recent heatmap requests. Each
+# web worker keeps its own window; pool jobs report back to the worker that
+# submitted them.
+METRICS_WINDOW = int(os.getenv("HEATMAP_METRICS_WINDOW", "500"))
+# Seconds between RSS samples while a request runs
+RSS_SAMPLE_INTERVAL = float(os.getenv("HEATMAP_RSS_SAMPLE_INTERVAL", "0.05"))
+# Functions listed in a ?profile=1 report
+PROFILE_LIMIT = 40
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+_samples = deque(maxlen=METRICS_WINDOW)
+_totals = {"requests": 0, "errors": 0}
+_metrics_lock = threading.Lock()
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    if resource is not None:
+        # Lifetime peak rather than current, reported in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+
+def os_threading():
+    """
+    The threading module backed by OS threads. After eventlet.monkey_patch()
+    threading.Thread is a green thread, which never runs while CPU-bound work
+    holds the hub.
+    """
+    if eventlet_patcher is not None and eventlet_patcher.is_monkey_patched("thread"):
+        return eventlet_patcher.original("threading")
+    return threading
+
+
+class PeakRSSSampler:
+    """Sample RSS on a background OS thread while the block runs and keep the peak."""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._threading = os_threading()
+        self._stop = self._threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        self.peak = max(self.peak, current_rss())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = self._threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+
+def record_request(source, timings, peak_rss, ok=True, cached=False):
+    with _metrics_lock:
+        _totals["requests"] += 1
+        if not ok:
+            _totals["errors"] += 1
+        _samples.append(
+            {
+                "source": source,
+                "timings": dict(timings),
+                "peak_rss": peak_rss,
+                "ok": ok,
+                "cached": cached,
+                "at": time.time(),
+            }
+        )
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype="float64")
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "mean": round(float(values.mean()), 4),
+        "p50": round(float(p50), 4),
+        "p90": round(float(p90), 4),
+        "p99": round(float(p99), 4),
+        "max": round(float(values.max()), 4),
+    }
+
+
+def metrics_summary():
+    """Percentiles per stage, of total time and of peak RSS over the rolling window."""
+    with _metrics_lock:
+        samples = list(_samples)
+        totals = dict(_totals)
+
+    stage_names = HEATMAP_STAGES + sorted(
+        {name for s in samples for name in s["timings"]} - set(HEATMAP_STAGES)
+    )
+    stages = {}
+    for name in stage_names:
+        summary = _percentiles(
+            [s["timings"][name] for s in samples if name in s["timings"]]
+        )
+        if summary is not None:
+            stages[name] = summary
+
+    return {
+        **totals,
+        "window": len(samples),
+        "cached": sum(1 for s in samples if s["cached"]),
+        "stages": stages,
+        "total_s": _percentiles([sum(s["timings"].values()) for s in samples]),
+        "peak_rss_mb": _percentiles([s["peak_rss"] / 1024**2 for s in samples]),
+    }
+
+
+def profile_call(func, *args, **kwargs):
+    """Run func under cProfile. Returns its result and the cumulative-time report."""
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(
+        PROFILE_LIMIT
+    )
+    return result, report.getvalue()
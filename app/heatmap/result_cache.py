@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, the lock is then per process only
+    fcntl = None
+
+from .result_store import RESULT_STORE_DIR, get_result_store
+
+# Zipcode Heatmap Generation Project
+# Content-addressed cache of generated heatmaps. Requests are keyed by the hash
+# of the uploaded file plus the submitted form fields, so re-submitting the same
+# spreadsheet with the same choices returns the existing result files. The index
+# is a JSON file beside the results so pool processes can register entries too,
+# guarded by a lock file; the files themselves live in the result store.
+RESULT_DIR = RESULT_STORE_DIR
+CACHE_INDEX_PATH = os.path.join(RESULT_DIR, ".cache_index.json")
+# Total size of cached result files before least recently used entries are evicted
+CACHE_MAX_BYTES = int(os.getenv("HEATMAP_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def cache_key(filepath, form):
+    """Hash the uploaded file bytes together with the form fields."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    digest.update(json.dumps(dict(form), sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+@contextmanager
+def _locked_index():
+    """
+    Serialize index read-modify-write cycles between threads of this process
+    and, through an flock on a lock file, between the web and pool processes.
+    """
+    with _cache_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(CACHE_INDEX_PATH), exist_ok=True)
+        with open(f"{CACHE_INDEX_PATH}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_index():
+    try:
+        with open(CACHE_INDEX_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_index(index):
+    os.makedirs(os.path.dirname(CACHE_INDEX_PATH), exist_ok=True)
+    tmp_path = f"{CACHE_INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, CACHE_INDEX_PATH)
+
+
+def _remove_files(filenames):
+    store = get_result_store()
+    for filename in filenames:
+        store.delete(filename)
+
+
+def lookup_result(key):
+    """Return the cached response payload for key, or None on a miss."""
+    with _locked_index():
+        index = _load_index()
+        entry = index.get(key)
+        store = get_result_store()
+        if entry is not None and not all(
+            store.exists(filename) for filename in entry["files"]
+        ):
+            # Result files expired or were removed behind the cache's back
+            del index[key]
+            _save_index(index)
+            entry = None
+
+        if entry is None:
+            _cache_stats["misses"] += 1
+            return None
+
+        _cache_stats["hits"] += 1
+        entry["last_used"] = time.time()
+        _save_index(index)
+        return entry["result"]
+
+
+def store_result(key, result, filenames):
+    """Register freshly generated result files under key and enforce the size bound."""
+    store = get_result_store()
+    size = 0
+    for filename in filenames:
+        metadata = store.metadata(filename)
+        # Compressed copies count towards the cache size too
+        size += metadata["size"] + sum(metadata["encodings"].values())
+    with _locked_index():
+        index = _load_index()
+        index[key] = {
+            "result": result,
+            "files": list(filenames),
+            "size": size,
+            "last_used": time.time(),
+        }
+        _evict(index, keep=key)
+        _save_index(index)
+
+
+def _evict(index, keep=None):
+    total = sum(entry["size"] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]["last_used"]):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if key == keep:
+            continue
+        entry = index.pop(key)
+        _remove_files(entry["files"])
+        total -= entry["size"]
+        _cache_stats["evictions"] += 1
+
+
+def cache_stats():
+    with _locked_index():
+        index = _load_index()
+        return {
+            **_cache_stats,
+            "entries": len(index),
+            "bytes": sum(entry["size"] for entry in index.values()),
+            "max_bytes": CACHE_MAX_BYTES,
+        }
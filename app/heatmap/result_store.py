@@ -0,0 +1,398 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+try:
+    import brotli
+except ImportError:  # Results are precompressed with gzip only
+    brotli = None
+
+# Zipcode Heatmap Generation Project
+# Storage for generated heatmap results. Every result is written once with a
+# metadata record holding its expiry time, plus gzip (and brotli when available)
+# copies of the text formats so they can be served compressed without
+# recompressing on each request. A background sweeper deletes expired results.
+RESULT_STORE_DIR = os.getenv(
+    "HEATMAP_RESULT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "heatmap/result"),
+)
+# "local" or "s3"
+RESULT_STORE_BACKEND = os.getenv("HEATMAP_RESULT_STORE", "local")
+RESULT_S3_BUCKET = os.getenv("HEATMAP_S3_BUCKET")
+RESULT_S3_PREFIX = os.getenv("HEATMAP_S3_PREFIX", "heatmap/result/")
+# Set to an S3-compatible endpoint (MinIO, a local stand-in) instead of AWS
+RESULT_S3_ENDPOINT_URL = os.getenv("HEATMAP_S3_ENDPOINT_URL")
+# Seconds a result is kept, 0 keeps results forever
+RESULT_TTL = int(os.getenv("HEATMAP_RESULT_TTL", str(7 * 24 * 3600)))
+# Seconds between sweeps for expired results
+SWEEP_INTERVAL = int(os.getenv("HEATMAP_SWEEP_INTERVAL", "3600"))
+# Longest Cache-Control max-age sent for a result. Result names are unique, so
+# their content never changes while they exist.
+RESULT_MAX_AGE = int(os.getenv("HEATMAP_RESULT_MAX_AGE", str(24 * 3600)))
+# Seconds a presigned S3 download link stays valid
+PRESIGNED_URL_EXPIRY = 3600
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COPY_BUFFER = 1024 * 1024
+
+CONTENT_TYPES = {
+    ".html": "text/html",
+    ".kml": "application/vnd.google-earth.kml+xml",
+    ".kmz": "application/vnd.google-earth.kmz",
+}
+# Formats worth precompressing, KMZ is already a zip archive
+COMPRESSIBLE = {".html", ".kml"}
+# Content-Encoding -> file suffix of the precompressed copy
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+METADATA_SUFFIX = ".meta.json"
+
+_store = None
+_store_lock = threading.Lock()
+_sweeper = None
+_sweep_hooks = []
+
+
+def content_type_for(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1].lower())
+
+
+def _compress_gzip(source_path, target_path):
+    with open(source_path, "rb") as src, gzip.open(
+        target_path, "wb", compresslevel=GZIP_LEVEL
+    ) as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER)
+
+
+def _compress_brotli(source_path, target_path):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    with open(source_path, "rb") as src, open(target_path, "wb") as dst:
+        for block in iter(lambda: src.read(COPY_BUFFER), b""):
+            dst.write(compressor.process(block))
+        dst.write(compressor.finish())
+
+
+def precompress(path):
+    """Write compressed siblings of path. Returns {encoding: sibling path}."""
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE:
+        return {}
+    siblings = {"gzip": path + ENCODING_SUFFIXES["gzip"]}
+    _compress_gzip(path, siblings["gzip"])
+    if brotli is not None:
+        siblings["br"] = path + ENCODING_SUFFIXES["br"]
+        _compress_brotli(path, siblings["br"])
+    return siblings
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def new_metadata(filename, size, encodings, ttl, etag=None):
+    now = time.time()
+    return {
+        "filename": filename,
+        "content_type": content_type_for(filename),
+        "size": size,
+        "encodings": encodings,
+        "etag": etag,
+        "created_at": now,
+        "expires_at": now + ttl if ttl else None,
+    }
+
+
+def variant_etag(metadata, encoding=None):
+    """Strong ETag for the stored bytes, distinct for each compressed copy."""
+    if metadata.get("etag") is None:
+        return None
+    return f"{metadata['etag']}-{encoding}" if encoding else metadata["etag"]
+
+
+def cache_max_age(metadata, now=None):
+    """Cache-Control max-age for a result, never beyond its expiry."""
+    expires_at = metadata.get("expires_at")
+    if expires_at is None:
+        return RESULT_MAX_AGE
+    return max(0, min(RESULT_MAX_AGE, int(expires_at - (now or time.time()))))
+
+
+def is_expired(metadata, now=None):
+    expires_at = metadata.get("expires_at")
+    return expires_at is not None and expires_at <= (now or time.time())
+
+
+class LocalResultStore:
+    """
+    Results in a local directory, spread over hashed subfolders so no single
+    directory grows without bound. Each result has a .meta.json record beside it.
+    """
+
+    def __init__(self, root, ttl=RESULT_TTL):
+        self.root = root
+        self.ttl = ttl
+
+    def _shard(self, filename):
+        return hashlib.md5(filename.encode()).hexdigest()[:2]
+
+    def _path(self, filename):
+        return os.path.join(self.root, self._shard(filename), filename)
+
+    def local_path(self, filename, encoding=None):
+        """Path of the stored file (or its compressed copy), or None if missing."""
+        path = self._path(filename)
+        if not os.path.exists(path):
+            # Results written before sharding sit directly in the root
+            path = os.path.join(self.root, filename)
+            if not os.path.exists(path):
+                return None
+        if encoding is not None:
+            path += ENCODING_SUFFIXES[encoding]
+        return path
+
+    def url(self, filename, encoding=None):
+        return None
+
+    def put(self, filename, source_path, ttl=None):
+        """Move source_path into the store as filename, compressing it once."""
+        path = self._path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Falls back to copy and delete when the source is on another filesystem
+        shutil.move(source_path, path)
+        siblings = precompress(path)
+        metadata = new_metadata(
+            filename,
+            os.path.getsize(path),
+            {encoding: os.path.getsize(p) for encoding, p in siblings.items()},
+            self.ttl if ttl is None else ttl,
+            etag=file_digest(path),
+        )
+        tmp_path = f"{path}{METADATA_SUFFIX}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, path + METADATA_SUFFIX)
+        return metadata
+
+    def metadata(self, filename):
+        path = self.local_path(filename)
+        if path is None:
+            return None
+        try:
+            with open(path + METADATA_SUFFIX) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Unmanaged file, served as is and never expired
+            return new_metadata(filename, os.path.getsize(path), {}, 0)
+
+    def exists(self, filename):
+        return self.local_path(filename) is not None
+
+    def open(self, filename, encoding=None):
+        return open(self.local_path(filename, encoding), "rb")
+
+    def delete(self, filename):
+        path = self.local_path(filename)
+        if path is None:
+            return
+        for suffix in ["", METADATA_SUFFIX, *ENCODING_SUFFIXES.values()]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def sweep(self, now=None):
+        """Delete expired results. Returns the number removed."""
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or len(shard.name) != 2:
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(METADATA_SUFFIX):
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        metadata = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+                if is_expired(metadata, now):
+                    self.delete(metadata["filename"])
+                    removed += 1
+        return removed
+
+
+class S3ResultStore:
+    """Results in an S3 bucket (or any S3-compatible service) under a key prefix."""
+
+    def __init__(self, bucket, prefix=RESULT_S3_PREFIX, client=None, ttl=RESULT_TTL):
+        if client is None:
+            import boto3
+
+            client = boto3.client("s3", endpoint_url=RESULT_S3_ENDPOINT_URL)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, filename):
+        return self.prefix + filename
+
+    def local_path(self, filename, encoding=None):
+        return None
+
+    def url(self, filename, encoding=None):
+        """Presigned download link for the stored file or its compressed copy."""
+        key = self._key(filename)
+        if encoding is not None:
+            key += ENCODING_SUFFIXES[encoding]
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
+        )
+
+    def put(self, filename, source_path, ttl=None):
+        """Upload source_path and its compressed copies, then remove the local files."""
+        siblings = precompress(source_path)
+        ttl = self.ttl if ttl is None else ttl
+        # S3 answers conditional and range requests for these objects itself
+        extra_args = {
+            "ContentType": content_type_for(filename),
+            "CacheControl": f"public, max-age={min(ttl or RESULT_MAX_AGE, RESULT_MAX_AGE)}",
+        }
+        key = self._key(filename)
+        try:
+            self.client.upload_file(source_path, self.bucket, key, ExtraArgs=extra_args)
+            for encoding, path in siblings.items():
+                self.client.upload_file(
+                    path,
+                    self.bucket,
+                    key + ENCODING_SUFFIXES[encoding],
+                    ExtraArgs={**extra_args, "ContentEncoding": encoding},
+                )
+            metadata = new_metadata(
+                filename,
+                os.path.getsize(source_path),
+                {encoding: os.path.getsize(p) for encoding, p in siblings.items()},
+                ttl,
+                etag=file_digest(source_path),
+            )
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key + METADATA_SUFFIX,
+                Body=json.dumps(metadata).encode(),
+                ContentType="application/json",
+            )
+        finally:
+            for path in [source_path, *siblings.values()]:
+                if os.path.exists(path):
+                    os.remove(path)
+        return metadata
+
+    def metadata(self, filename):
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._key(filename) + METADATA_SUFFIX
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response["Body"].read())
+
+    def exists(self, filename):
+        return self.metadata(filename) is not None
+
+    def open(self, filename, encoding=None):
+        key = self._key(filename)
+        if encoding is not None:
+            key += ENCODING_SUFFIXES[encoding]
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def delete(self, filename):
+        key = self._key(filename)
+        self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={
+                "Objects": [
+                    {"Key": key + suffix}
+                    for suffix in ["", METADATA_SUFFIX, *ENCODING_SUFFIXES.values()]
+                ]
+            },
+        )
+
+    def sweep(self, now=None):
+        """Delete expired results. Returns the number removed."""
+        removed = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                if not item["Key"].endswith(METADATA_SUFFIX):
+                    continue
+                filename = item["Key"][len(self.prefix) : -len(METADATA_SUFFIX)]
+                metadata = self.metadata(filename)
+                if metadata is not None and is_expired(metadata, now):
+                    self.delete(filename)
+                    removed += 1
+        return removed
+
+
+def get_result_store():
+    """Return the configured result store, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if RESULT_STORE_BACKEND == "s3":
+                _store = S3ResultStore(RESULT_S3_BUCKET)
+            else:
+                _store = LocalResultStore(RESULT_STORE_DIR)
+        return _store
+
+
+def set_result_store(store):
+    """Replace the result store, returning the previous one."""
+    global _store
+    with _store_lock:
+        previous, _store = _store, store
+        return previous
+
+
+def add_sweep_hook(func):
+    """
+    Call func(store) after every sweep, for files whose lifetime follows the
+    results in the store.
+    """
+    with _store_lock:
+        if func not in _sweep_hooks:
+            _sweep_hooks.append(func)
+
+
+def _sweep_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            store = get_result_store()
+            removed = store.sweep()
+            if removed:
+                print(f"Removed {removed} expired heatmap results")
+            with _store_lock:
+                hooks = list(_sweep_hooks)
+            for hook in hooks:
+                hook(store)
+        except Exception as e:
+            print(f"Heatmap result sweep failed: {e}")
+
+
+def start_sweeper(interval=SWEEP_INTERVAL):
+    """Start the background thread deleting expired results, once per process."""
+    global _sweeper
+    with _store_lock:
+        if _sweeper is None and interval > 0:
+            _sweeper = threading.Thread(
+                target=_sweep_forever, args=(interval,), daemon=True
+            )
+            _sweeper.start()
@@ -1,83 +1,68 @@
-from flask import Blueprint, current_app, request, jsonify, send_from_directory
+from flask import Blueprint, Response, current_app, redirect, request, jsonify, send_file
 import os
-import json
 import folium
 import uuid
-import simplekml
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 from folium import Choropleth
+from branca.colormap import StepColormap
 from werkzeug.utils import secure_filename
+from .geo_store import DETAIL_TIERS, get_zcta_geometries
+from .zip_reference import lookup_state_codes
+from .ingest import AGG_MODES, UploadError, read_upload
+from .kml_writer import KMLWriter, escape_series, open_kml_stream, package_kmz
+from .geojson_builder import build_feature_collection
+from .map_view import VIEW_STRATEGIES, map_view
+from .shared_geojson import add_metric_layers, add_shared_heatmap_layers
+from .stage_timer import StageTimer
+from .pipeline_metrics import (
+    PeakRSSSampler,
+    metrics_summary,
+    profile_call,
+    record_request,
+)
+from .vector_tiles import (
+    MAX_ZOOM,
+    export_tileset,
+    get_tile,
+    mapbox_vector_tile,
+    sweep_tilesets,
+    tileset_exists,
+    write_viewer,
+)
+from .result_cache import cache_key, cache_stats, lookup_result, store_result
+from .result_store import (
+    ENCODING_SUFFIXES,
+    RESULT_STORE_DIR,
+    add_sweep_hook,
+    cache_max_age,
+    get_result_store,
+    start_sweeper,
+    variant_etag,
+)
+from .jobs import (
+    JobQueueFull,
+    new_job_id,
+    read_job_status,
+    submit_job,
+    sweep_jobs,
+    write_job_status,
+)
 
 heatmap_bp = Blueprint("heatmap_bp", __name__)
 
 from . import routes
 
 # Zipcode Heatmap Generation Project
-# Directory to save the generated heatmaps
-HEATMAP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "heatmap/result")
+# Generated heatmaps are written here, then moved into the result store. Staged
+# beside the stored results so the move stays on one filesystem.
+HEATMAP_DIR = RESULT_STORE_DIR
+os.makedirs(HEATMAP_DIR, exist_ok=True)
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "heatmap/data")
-ZIPS_DIR = os.path.join(
-    os.path.dirname(os.path.abspath(__file__)), "static/USA_zip_list.csv"
-)
-GEO_DIR = os.path.join(
-    os.path.dirname(os.path.abspath(__file__)), "State-zip-code-GeoJSON"
-)
 
-ALLOWED_EXTENSIONS = {"xls", "xlsx", "csv"}
-
-STATE_DICT = {
-    "AL": "alabama",
-    "AK": "alaska",
-    "AZ": "arizona",
-    "AR": "arkansas",
-    "CA": "california",
-    "CO": "colorado",
-    "CT": "connecticut",
-    "DE": "delaware",
-    "FL": "florida",
-    "GA": "georgia",
-    "HI": "hawaii",
-    "ID": "idaho",
-    "IL": "illinois",
-    "IN": "indiana",
-    "IA": "iowa",
-    "KS": "kansas",
-    "KY": "kentucky",
-    "LA": "louisiana",
-    "ME": "maine",
-    "MD": "maryland",
-    "MA": "massachusetts",
-    "MI": "michigan",
-    "MN": "minnesota",
-    "MS": "mississippi",
-    "MO": "missouri",
-    "MT": "montana",
-    "NE": "nebraska",
-    "NV": "nevada",
-    "NH": "new hampshire",
-    "NJ": "new jersey",
-    "NM": "new mexico",
-    "NY": "new york",
-    "NC": "north carolina",
-    "ND": "north dakota",
-    "OH": "ohio",
-    "OK": "oklahoma",
-    "OR": "oregon",
-    "PA": "pennsylvania",
-    "RI": "rhode island",
-    "SC": "south carolina",
-    "SD": "south dakota",
-    "TN": "tennessee",
-    "TX": "texas",
-    "UT": "utah",
-    "VT": "vermont",
-    "VA": "virginia",
-    "WA": "washington",
-    "WV": "west virginia",
-    "WI": "wisconsin",
-    "WY": "wyoming",
-}
+ALLOWED_EXTENSIONS = {"xlsx", "csv"}
+GEOMETRY_MODES = ("inline", "shared")
+OUTPUT_MODES = ("map", "tiles")
 
 
 # Zipcode Heatmap Generation Project
@@ -94,147 +79,163 @@ def parse_input(input_str):
 
 
 # Zipcode Heatmap Generation Project
-def preprocess_data(filename, exclude_index=0):
-    # Determine the file type and read accordingly
-    if filename.endswith(".xlsx"):
-        df = pd.read_excel(filename)
-    elif filename.endswith(".csv"):
-        df = pd.read_csv(filename)
-    else:
-        raise ValueError("Unsupported file format")
-
-    # Get the column name based on the provided index
-    exclude_column = df.columns[exclude_index] if exclude_index is not None else None
-
-    # Iterate over all values in the dataframe, excluding the specified column
-    for col in df.columns:
-        if col != exclude_column:
-            df[col] = df[col].apply(lambda x: convert_to_number(x))
-
-    return df
+@heatmap_bp.record_once
+def start_result_sweeper(state):
+    # Only the web process sweeps, pool processes just write results. Tilesets
+    # go with their viewer page.
+    add_sweep_hook(sweep_tilesets)
+    add_sweep_hook(sweep_expired_jobs)
+    start_sweeper()
 
 
 # Zipcode Heatmap Generation Project
-def convert_to_number(val):
-    # If value is a string, remove commas
-    if isinstance(val, str):
-        val = val.replace(",", "")
-
-    # Try converting to a number
-    try:
-        number = float(val)
-        return number
-    except ValueError:
-        return "0"
+def sweep_expired_jobs(store):
+    removed = sweep_jobs()
+    if removed:
+        print(f"Removed {removed} expired heatmap job statuses")
 
 
 # Zipcode Heatmap Generation Project
 @heatmap_bp.route("/result/<filename>")
 def serve_file(filename):
-    # Modify the function to serve both HTML and KML files with content type checks
+    # Serves HTML, KML and KMZ results from the result store
     if ".." in filename or filename.startswith("/"):
         return "Invalid path!", 400
 
-    file_path = os.path.join(HEATMAP_DIR, filename)
-    print(file_path)
-    if not os.path.exists(file_path):
+    store = get_result_store()
+    metadata = store.metadata(filename)
+    if metadata is None:
         return "File not found!", 404
 
-    # Infer content type from file extension
-    if filename.endswith(".html"):
-        content_type = "text/html"
-    elif filename.endswith(".kml"):
-        content_type = "application/vnd.google-earth.kml+xml"
-    else:
+    content_type = metadata["content_type"]
+    if content_type is None:
         return "Invalid file type!", 400
 
-    return send_from_directory(HEATMAP_DIR, filename, mimetype=content_type)
+    # Send the precompressed copy the client prefers, brotli over gzip
+    available = [e for e in ENCODING_SUFFIXES if e in metadata["encodings"]]
+    encoding = request.accept_encodings.best_match(available) if available else None
+
+    local_path = store.local_path(filename, encoding)
+    if local_path is None:
+        # Remote stores serve the bytes, with their own ETag and range handling
+        response = redirect(store.url(filename, encoding))
+    else:
+        # Conditional GET (ETag -> 304) and Range requests are answered by send_file
+        response = send_file(
+            local_path,
+            mimetype=content_type,
+            # Name the download after the result, not its .gz/.br copy
+            download_name=filename,
+            etag=variant_etag(metadata, encoding) or True,
+            max_age=cache_max_age(metadata),
+        )
+        # Remote stores keep Content-Encoding on the object, not the redirect
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+
+    if available:
+        response.vary.add("Accept-Encoding")
+    return response
 
 
 # Zipcode Heatmap Generation Project
-def generate_kml(geojson_data, col_name, other_cols, max_value, min_value, file_prefix):
-    kml = simplekml.Kml()
-
-    for feature in geojson_data["features"]:
-        # Zip code polygons represented as 'MultiPolygon' or 'Polygon' in GeoJSON
-        poly_geojson = feature["geometry"]
-        if poly_geojson["type"] == "MultiPolygon":
-            for polygon in poly_geojson["coordinates"]:
-                create_kml_polygon(
-                    kml, polygon, feature, col_name, other_cols, max_value, min_value
-                )
-        elif poly_geojson["type"] == "Polygon":
-            create_kml_polygon(
-                kml,
-                poly_geojson["coordinates"],
-                feature,
-                col_name,
-                other_cols,
-                max_value,
-                min_value,
+def new_kml_path(file_prefix, kmz=False):
+    extension = "kmz" if kmz else "kml"
+    return os.path.join(HEATMAP_DIR, f"{file_prefix}_{uuid.uuid4().hex}.{extension}")
+
+
+# Zipcode Heatmap Generation Project
+def generate_kml(geo_df, col_name, other_cols, file_prefix, kmz=False):
+    kml_file_path = new_kml_path(file_prefix, kmz)
+
+    with open_kml_stream(kml_file_path, kmz=kmz) as handle:
+        writer = KMLWriter(handle)
+        writer.start(KML_COLOR_BINS)
+        writer.write_placemarks(
+            escape_series(geo_df["ZCTA5CE10"]),
+            build_balloon_text(geo_df, col_name, other_cols),
+            geo_df.geometry.values,
+            geo_df["color_bin"],
+        )
+        writer.end()
+
+    return kml_file_path
+
+
+# Zipcode Heatmap Generation Project
+# One KML folder per metric, only the first is visible when the file is opened
+def generate_bundle_kml(geo_df, metric_names, other_cols, file_prefix, kmz=False):
+    kml_file_path = new_kml_path(file_prefix, kmz)
+    names = escape_series(geo_df["ZCTA5CE10"])
+
+    with open_kml_stream(kml_file_path, kmz=kmz) as handle:
+        writer = KMLWriter(handle)
+        writer.start(KML_COLOR_BINS)
+        for i, metric in enumerate(metric_names):
+            writer.open_folder(metric, visible=i == 0)
+            writer.write_placemarks(
+                names,
+                build_balloon_text(geo_df, metric, other_cols),
+                geo_df.geometry.values,
+                geo_df[f"color_bin_{i}"],
             )
+            writer.close_folder()
+        writer.end()
 
-    kml_file_path = os.path.join(HEATMAP_DIR, f"{file_prefix}_{uuid.uuid4().hex}.kml")
-    kml.save(kml_file_path)
     return kml_file_path
 
 
 # Zipcode Heatmap Generation Project
-def create_kml_polygon(
-    kml, polygon, feature, col_name, other_cols, max_value, min_value
-):
-    poly = kml.newpolygon(name=feature["properties"]["ZCTA5CE10"])
+def build_balloon_text(geo_df, col_name, other_cols):
+    # Built a column at a time rather than per feature
+    balloon_text = f"{col_name}: " + geo_df[col_name].astype(str) + "\n"
+    other_lines = [f"{name}: " + geo_df[name].astype(str) for name in other_cols]
+    if other_lines:
+        joined = other_lines[0]
+        for line in other_lines[1:]:
+            joined = joined + "\n" + line
+        balloon_text = balloon_text + joined
+    return escape_series(balloon_text)
 
-    balloon_text = f"{col_name}: {feature['properties'][col_name]}\n"
 
-    balloon_text += "\n".join(
-        [f"{col_name}: {feature['properties'][col_name]}" for col_name in other_cols]
-    )
-    poly.description = balloon_text
-
-    # Assign the balloon text to the BalloonStyle
-    # poly.style.balloonstyle.text = balloon_html
-    # Convert coordinates to the correct format
-    kml_coordinates = convert_coordinates_to_kml(polygon)
-    poly.outerboundaryis = kml_coordinates
-    value = feature["properties"][col_name]
-    poly.style.polystyle.color = simplekml.Color.changealphaint(
-        175, color_scale(value, max_value, min_value, kml=True)
-    )
-    poly.style.polystyle.outline = 3
-    # You can set altitude mode here if needed, for example:
-    # poly.altitudemode = simplekml.AltitudeMode.clamptoground
+# Zipcode Heatmap Generation Project
+# Color bins for the heatmap. A value falls in bin i + 1 when it is below
+# min + (max - min) * COLOR_BIN_EDGES[i]; bin 0 is transparent (no data / zero).
+COLOR_BIN_EDGES = np.array([0.1, 0.25, 0.4, 0.55, 0.7, 0.8, 0.9])
+COLOR_BINS = np.array(
+    [
+        "#ffffff00",
+        "#ffffb2",
+        "#feda76",
+        "#f5b156",
+        "#f59356",
+        "#f07f64",
+        "#ec5b45",
+        "#e73727",
+        "#d7191c",
+    ]
+)
 
 
 # Zipcode Heatmap Generation Project
-# Modify color_scale to support KML color generation
-def color_scale(value, max_value, min_value, kml=False):
-    diff = max_value - min_value
-    if value is None:
-        color = "#ffffff00"
-    elif value == 0:
-        color = "#ffffff00"
-    elif value < (diff * 0.1) + min_value:
-        color = "#ffffb2"
-    elif value < (diff * 0.25) + min_value:
-        color = "#feda76"
-    elif value < (diff * 0.4) + min_value:
-        color = "#f5b156"
-    elif value < (diff * 0.55) + min_value:
-        color = "#f59356"
-    elif value < (diff * 0.7) + min_value:
-        color = "#f07f64"
-    elif value < (diff * 0.8) + min_value:
-        color = "#ec5b45"
-    elif value < (diff * 0.9) + min_value:
-        color = "#e73727"
-    else:
-        color = "#d7191c"
+def assign_color_bins(values, max_value, min_value):
+    values = np.asarray(values, dtype="float64")
+    edges = min_value + (max_value - min_value) * COLOR_BIN_EDGES
+    color_bins = np.digitize(values, edges) + 1
+    color_bins[np.isnan(values) | (values == 0)] = 0
+    return color_bins
 
-    # Convert hex color to KML format if kml parameter is true
-    if kml:
-        return html_color_to_kml_color(color)
-    return color
+
+# Zipcode Heatmap Generation Project
+def color_legend(caption, max_value, min_value):
+    edges = min_value + (max_value - min_value) * COLOR_BIN_EDGES
+    return StepColormap(
+        list(COLOR_BINS[1:]),
+        index=[min_value, *edges, max_value],
+        vmin=min_value,
+        vmax=max_value,
+        caption=caption,
+    )
 
 
 # Zipcode Heatmap Generation Project
@@ -246,17 +247,8 @@ def html_color_to_kml_color(html_color, alpha="22"):
 
 
 # Zipcode Heatmap Generation Project
-def convert_coordinates_to_kml(polygon):
-    # GeoJSON coordinates are in [longitude, latitude] order, may include altitude
-    # KML expects a list of tuples in (longitude, latitude[, altitude]) order
-    # Assuming polygon is a list of lists where each inner list represents a point
-    # In GeoJSON, polygons are an array of LinearRings (first is outer, rest are holes)
-    # For simplicity, this function only converts the outer boundary
-
-    outer_boundary = polygon[0]  # Get the outer boundary (ignore holes)
-    return [
-        (lon, lat) for lon, lat in outer_boundary
-    ]  # KML has only lon, lat for LinearRing
+# KML polygon colors per bin, with the 175 alpha used for every placemark
+KML_COLOR_BINS = [html_color_to_kml_color(color, alpha="af") for color in COLOR_BINS]
 
 
 # Zipcode Heatmap Generation Project
@@ -270,197 +262,548 @@ def get_column_names_from_indices(df, sec_col_input):
     return column_names
 
 
-@heatmap_bp.route("/zipcode", methods=["POST"])
-def generate_heatmap():
-    if "excel_file" not in request.files:
-        return jsonify({"error": "No file provided"}), 400
-    file = request.files["excel_file"]
+# Zipcode Heatmap Generation Project
+class HeatmapError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Zipcode Heatmap Generation Project
+def validate_heatmap_request(files, form):
+    if "excel_file" not in files:
+        raise HeatmapError("No file provided")
+    file = files["excel_file"]
 
     # Check if user did not select file
     if file.filename == "":
-        return jsonify({"error": "No file selected"}), 400
+        raise HeatmapError("No file selected")
 
     # Check if file is allowed
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(DATA_DIR, filename)
-        file.save(filepath)
-        # Now, use the saved file path in your existing code
-        excel_path = filepath
-
-        input_df = preprocess_data(
-            excel_path, exclude_index=int(request.form.get("zip_col"))
-        )
-
-        main_col = int(request.form.get("main_col"))
-        zip_col = int(request.form.get("zip_col"))
-        other_cols = parse_input(request.form.get("sec_col"))
-        other_cols.insert(0, main_col)
-
-        col_names = input_df.columns.tolist()
-        max_value = input_df[col_names[main_col]].max()
-        min_value = input_df[col_names[main_col]].min()
+    if not allowed_file(file.filename):
+        raise HeatmapError("Invalid file type")
 
-        # Ensure zip codes are treated as strings
-        input_df[col_names[zip_col]] = input_df[col_names[zip_col]].astype(str).str.zfill(5)
+    if not form.get("main_col") and not form.get("main_cols"):
+        raise HeatmapError("No metric column selected")
 
-        # Extract the zip codes while ensuring leading zeros are kept
-        input_df["Parsed Zip Code"] = input_df[col_names[zip_col]].str.extract(r"(\d{5})")[0].astype(str).str.zfill(5)
+    # Rows are located either by a zip column or by a latitude/longitude pair
+    if not form.get("zip_col") and not (form.get("lat_col") and form.get("lon_col")):
+        raise HeatmapError("No zip column or lat_col/lon_col pair selected")
 
-        us_zips = pd.read_csv(ZIPS_DIR, dtype={"zip_code": str})
+    # Geometry detail tier used for both the map and the KML
+    if form.get("detail", "full") not in DETAIL_TIERS:
+        raise HeatmapError(f"Invalid detail, expected one of {list(DETAIL_TIERS)}")
 
-        us_zips["zip_code"] = us_zips["zip_code"].astype(str).str.zfill(5)
-
-        merged_data = pd.merge(
-            input_df,
-            us_zips,
-            how="left",
-            left_on="Parsed Zip Code",
-            right_on="zip_code",
+    # "inline" embeds the geometry in each map layer, "shared" embeds it once
+    if form.get("geometry_mode", "inline") not in GEOMETRY_MODES:
+        raise HeatmapError(
+            f"Invalid geometry_mode, expected one of {list(GEOMETRY_MODES)}"
         )
 
-        # Filter out rows where the zip code was not found in us_zips
-        merged_data = merged_data[merged_data["zip_code"].notnull()]
+    # Start location strategy for the map, the server default when not given
+    if form.get("view") and form.get("view") not in VIEW_STRATEGIES:
+        raise HeatmapError(f"Invalid view, expected one of {list(VIEW_STRATEGIES)}")
 
-        unique_codes = merged_data["state_code"].unique().tolist()
-        state_values = []
+    # How rows sharing a zip code are combined before mapping
+    if form.get("agg", "sum") not in AGG_MODES:
+        raise HeatmapError(f"Invalid agg, expected one of {list(AGG_MODES)}")
 
-        for code in unique_codes:
-            state_name = STATE_DICT.get(code)
-            state_values.append(state_name)
+    # "map" renders the folium page and KML, "tiles" exports vector tiles and a viewer
+    output = form.get("output", "map")
+    if output not in OUTPUT_MODES:
+        raise HeatmapError(f"Invalid output, expected one of {list(OUTPUT_MODES)}")
+    if output == "tiles" and mapbox_vector_tile is None:
+        raise HeatmapError("Vector tile export is not available", status_code=501)
+    return file
 
-        filtered_new_geo_df = None
 
-        for state_code, state_name in zip(unique_codes, state_values):
-            file_name = (
-                f"{GEO_DIR}/{state_code.lower()}_{state_name}_zip_codes_geo.min.json"
-            )
+# Zipcode Heatmap Generation Project
+def save_upload(file):
+    # Prefix with a uuid so concurrent uploads of the same filename don't collide
+    filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+    filepath = os.path.join(DATA_DIR, filename)
+    file.save(filepath)
+    return filepath
 
-            entire_gdf = gpd.read_file(file_name)
 
-            if filtered_new_geo_df is None:
-                filtered_new_geo_df = entire_gdf
-            else:
-                filtered_new_geo_df = pd.concat([entire_gdf, filtered_new_geo_df])
+# Zipcode Heatmap Generation Project
+def build_heatmap(excel_path, form, timer=None):
+    """
+    Run the heatmap pipeline for a saved upload and the submitted form fields.
+    Returns the response payload with the map and KML urls.
+    """
+    timer = timer or StageTimer()
+    detail = form.get("detail", "full")
+    geometry_mode = form.get("geometry_mode", "inline")
+    output = form.get("output", "map")
+
+    # lat/lon uploads are matched to ZCTAs by point-in-polygon instead of a zip column
+    point_cols = None
+    if form.get("lat_col") and form.get("lon_col"):
+        point_cols = (int(form.get("lat_col")), int(form.get("lon_col")))
+
+    with timer.stage("parse"):
+        # Streamed in chunks and reduced to one row per zip as it is read, so
+        # the geometry merge below never sees duplicate zips
+        with open(excel_path, "rb") as handle:
+            try:
+                input_df, column_dtypes = read_upload(
+                    handle,
+                    excel_path,
+                    zip_col=int(form.get("zip_col") or 0),
+                    agg=form.get("agg", "sum"),
+                    point_cols=point_cols,
+                )
+            except UploadError as e:
+                raise HeatmapError(str(e))
+
+    # main_cols renders several metrics as toggleable layers over one copy of the geometry
+    main_cols = parse_input(form.get("main_cols")) or [int(form.get("main_col"))]
+    main_col = main_cols[0]
+    other_cols = parse_input(form.get("sec_col"))
+    other_cols = main_cols + other_cols
+
+    col_names = input_df.columns.tolist()
+    # The matched ZCTA is the last column of a lat/lon upload
+    zip_col = len(col_names) - 1 if point_cols else int(form.get("zip_col"))
+    metric_names = [col_names[i] for i in main_cols]
+    is_bundle = len(metric_names) > 1
+    max_value = input_df[col_names[main_col]].max()
+    min_value = input_df[col_names[main_col]].min()
+
+    with timer.stage("zip_lookup"):
+        # The zip column already holds the parsed 5 digit zips
+        input_df["Parsed Zip Code"] = input_df[col_names[zip_col]]
+
+        # Zips that are not in the USA reference table have no state and are ignored
+        state_codes = lookup_state_codes(input_df["Parsed Zip Code"])
+        unique_codes = state_codes.dropna().unique().tolist()
+
+    with timer.stage("geometry"):
+        # Only the polygons for the uploaded zips are pulled from the geometry store
+        filtered_new_geo_df = get_zcta_geometries(
+            unique_codes, input_df["Parsed Zip Code"], detail=detail
+        )
+    if filtered_new_geo_df.empty:
+        raise HeatmapError("No matching zip codes found")
 
-        file_prefix = request.form.get("city")
+    file_prefix = form.get("city")
 
-        filtered_new_geo_df = filtered_new_geo_df[
-            filtered_new_geo_df["ZCTA5CE10"].isin(input_df["Parsed Zip Code"].tolist())
-        ]
+    with timer.stage("merge"):
+        merged_geo_df = pd.merge(
+            filtered_new_geo_df,
+            input_df,
+            left_on="ZCTA5CE10",
+            right_on="Parsed Zip Code",
+            how="left",
+        ).fillna(0)
 
-        merged_geo_json = json.loads(
-            pd.merge(
-                filtered_new_geo_df,
-                input_df,
-                left_on="ZCTA5CE10",
-                right_on="Parsed Zip Code",
-                how="left",
-            )
-            .fillna(0)
-            .to_json()
+        # Colors are assigned to every zip in one pass and shipped as feature properties
+        merged_geo_df["color_bin"] = assign_color_bins(
+            merged_geo_df[col_names[main_col]], max_value, min_value
         )
+        merged_geo_df["fill_color"] = COLOR_BINS[merged_geo_df["color_bin"]]
 
-        bounds = filtered_new_geo_df.total_bounds
-        centroid = filtered_new_geo_df.geometry.unary_union.centroid
-        latitude = centroid.y
-        longitude = centroid.x
+        if is_bundle:
+            for i, metric in enumerate(metric_names):
+                color_bins = assign_color_bins(
+                    merged_geo_df[metric], input_df[metric].max(), input_df[metric].min()
+                )
+                merged_geo_df[f"color_bin_{i}"] = color_bins
+                merged_geo_df[f"fill_color_{i}"] = COLOR_BINS[color_bins]
+
+        if output == "map":
+            # Shared by the choropleth and tooltip layers, KML reads merged_geo_df directly
+            merged_geo_json = build_feature_collection(merged_geo_df)
+
+    fields = ["ZCTA5CE10"]
+    aliases = ["Zip Code: "]
+
+    for i, name in enumerate(col_names):
+        if i in other_cols:
+            fields.append(name)
+            aliases.append(name + ": ")
+
+    if output == "tiles":
+        return {
+            **build_tile_result(merged_geo_df, fields, file_prefix, timer),
+            "metrics": metric_names,
+            "dtypes": column_dtypes,
+        }
 
-        coordinates = [latitude, longitude]
+    with timer.stage("render"):
+        # Centered without dissolving the polygons, fit_bounds sets the final view
+        coordinates, fit_bounds = map_view(filtered_new_geo_df, form.get("view"))
         m = folium.Map(location=coordinates)
-        m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-
-        Choropleth(
-            geo_data=merged_geo_json,
-            name="choropleth",
-            data=input_df,
-            columns=[
-                "Parsed Zip Code",
-                col_names[main_col],
-            ],
-            key_on="feature.properties.ZCTA5CE10",
-            fill_color="YlOrRd",
-            fill_opacity=0.6,
-            line_opacity=0.2,
-            legend_name=col_names[main_col],
-            highlight=True,
-        ).add_to(m)
-
-        style_function = lambda x: {
-            "fillColor": color_scale(
-                x["properties"][col_names[main_col]], max_value, min_value
-            ),
-            "color": "black",
-            "weight": 1,
-            "fillOpacity": 0.7,
-        }
-        highlight_function = lambda x: {
+        m.fit_bounds(fit_bounds)
+
+        layer_style = {"color": "black", "weight": 1, "fillOpacity": 0.7}
+        hover_style = {
             "fillColor": "#000000",
             "color": "#000000",
             "fillOpacity": 0.50,
             "weight": 0.1,
         }
-        fields = ["ZCTA5CE10"]
-        aliases = ["Zip Code: "]
-
-        for i, name in enumerate(col_names):
-            if i in other_cols:
-                fields.append(name)
-                aliases.append(name + ": ")
-
-        NIL = folium.features.GeoJson(
-            merged_geo_json,
-            style_function=style_function,
-            control=False,
-            highlight_function=highlight_function,
-            tooltip=folium.features.GeoJsonTooltip(
+
+        def make_tooltip():
+            return folium.features.GeoJsonTooltip(
                 fields=fields,
                 aliases=aliases,
                 style=(
                     "background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
                 ),
-            ),
-        )
-        m.add_child(NIL)
-        m.keep_in_front(NIL)
+            )
+
+        if is_bundle:
+            # Bundles always share the geometry between the metric layers
+            add_metric_layers(
+                m, merged_geo_json, metric_names, layer_style, hover_style, make_tooltip
+            )
+            for metric in metric_names:
+                m.add_child(
+                    color_legend(metric, input_df[metric].max(), input_df[metric].min())
+                )
+        else:
+            choropleth = Choropleth(
+                geo_data=merged_geo_json,
+                name="choropleth",
+                data=input_df,
+                columns=[
+                    "Parsed Zip Code",
+                    col_names[main_col],
+                ],
+                key_on="feature.properties.ZCTA5CE10",
+                fill_color="YlOrRd",
+                fill_opacity=0.6,
+                line_opacity=0.2,
+                legend_name=col_names[main_col],
+                highlight=True,
+            )
 
+            if geometry_mode == "shared":
+                # Geometry is embedded once and referenced by both layers
+                add_shared_heatmap_layers(
+                    m, merged_geo_json, choropleth, layer_style, hover_style, make_tooltip()
+                )
+            else:
+                choropleth.add_to(m)
+
+                style_function = lambda x: {
+                    **layer_style,
+                    "fillColor": x["properties"]["fill_color"],
+                }
+                highlight_function = lambda x: hover_style
+
+                NIL = folium.features.GeoJson(
+                    merged_geo_json,
+                    style_function=style_function,
+                    control=False,
+                    highlight_function=highlight_function,
+                    tooltip=make_tooltip(),
+                )
+                m.add_child(NIL)
+                m.keep_in_front(NIL)
+
+    with timer.stage("kml"):
         # Get column names from sec_col input before generating the KML
-        sec_col_input = request.form.get("sec_col", "")
+        sec_col_input = form.get("sec_col", "")
         if sec_col_input:  # Only if sec_col_input is provided
             kml_cols = get_column_names_from_indices(input_df, sec_col_input)
         else:
             kml_cols = []
 
         # Then, pass other_cols along with the data to the KML generation function
-        kml_file_path = generate_kml(
-            merged_geo_json,
-            col_names[main_col],
-            kml_cols,
-            max_value,
-            min_value,
-            file_prefix,
-        )
+        if is_bundle:
+            kml_file_path = generate_bundle_kml(
+                merged_geo_df,
+                metric_names,
+                kml_cols,
+                file_prefix,
+                kmz=form.get("kml_format") == "kmz",
+            )
+        else:
+            kml_file_path = generate_kml(
+                merged_geo_df,
+                col_names[main_col],
+                kml_cols,
+                file_prefix,
+                kmz=form.get("kml_format") == "kmz",
+            )
 
         kml_filename = os.path.basename(
             kml_file_path
         )  # Get the file name from the path
 
+        # KML is also offered zipped as KMZ, Google Earth downloads it much faster
+        kmz_file_path = kml_file_path
+        if not kml_file_path.endswith(".kmz"):
+            kmz_file_path = package_kmz(kml_file_path)
+        kmz_filename = os.path.basename(kmz_file_path)
+
+    with timer.stage("save"):
         # Save the generated heatmap
         unique_filename = f"{uuid.uuid4().hex}.html"
         save_path = os.path.join(HEATMAP_DIR, file_prefix + "_" + unique_filename)
 
         m.save(save_path)
 
-        # Delete the user input spreadsheet
+        # Move the map and KML into the result store, compressed once here
+        store = get_result_store()
+        store.put(os.path.basename(save_path), save_path)
+        store.put(kml_filename, kml_file_path)
+        if kmz_filename != kml_filename:
+            store.put(kmz_filename, kmz_file_path)
+
+    return {
+        "status": "success",
+        "heatmap_url": f"{os.getenv('base_url_flask')}/heatmap/result/{file_prefix}_{unique_filename}",
+        "kml_url": f"{os.getenv('base_url_flask')}/heatmap/result/{kml_filename}",
+        "kmz_url": f"{os.getenv('base_url_flask')}/heatmap/result/{kmz_filename}",
+        "metrics": metric_names,
+        "dtypes": column_dtypes,
+    }
+
+
+# Zipcode Heatmap Generation Project
+def build_tile_result(merged_geo_df, fields, file_prefix, timer):
+    """
+    Export merged_geo_df as a vector tileset and write its viewer page.
+    The map and KML stages are skipped, tiles are cut when first requested.
+    """
+    base_url = os.getenv("base_url_flask")
+
+    viewer_filename = f"{file_prefix}_{uuid.uuid4().hex}.html"
+    with timer.stage("render"):
+        # The tileset is swept once its viewer leaves the result store
+        tileset_id = export_tileset(
+            merged_geo_df, fields + ["fill_color"], viewer_filename
+        )
+
+    with timer.stage("save"):
+        tile_url = f"{base_url}/heatmap/tiles/{tileset_id}/{{z}}/{{x}}/{{y}}"
+        write_viewer(
+            os.path.join(HEATMAP_DIR, viewer_filename),
+            tileset_id,
+            tile_url,
+            fields,
+            merged_geo_df.total_bounds,
+            title=file_prefix,
+        )
+        get_result_store().put(
+            viewer_filename, os.path.join(HEATMAP_DIR, viewer_filename)
+        )
+
+    return {
+        "status": "success",
+        "heatmap_url": f"{base_url}/heatmap/result/{viewer_filename}",
+        "tiles_url": tile_url,
+    }
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/tiles/<tileset_id>/<int:z>/<int:x>/<int:y>")
+def serve_tile(tileset_id, z, x, y):
+    if not tileset_exists(tileset_id):
+        return "Tileset not found!", 404
+    if not 0 <= z <= MAX_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+        return "Tile out of range!", 404
+
+    data = get_tile(tileset_id, z, x, y)
+    if not data:
+        # Nothing to draw here
+        return "", 204
+    return Response(data, mimetype="application/vnd.mapbox-vector-tile")
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/zipcode", methods=["POST"])
+def generate_heatmap():
+    try:
+        file = validate_heatmap_request(request.files, request.form)
+    except HeatmapError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+    # ?profile=1 bypasses the result cache and returns a cProfile report
+    profile = request.args.get("profile") == "1"
+    timer = StageTimer()
+    rss = PeakRSSSampler()
+    ok = cached = False
+    try:
+        with rss:
+            with timer.stage("upload"):
+                filepath = save_upload(file)
+
+            try:
+                if profile:
+                    result, report = profile_call(
+                        build_heatmap, filepath, request.form, timer
+                    )
+                    result = {**result, "profile": report}
+                else:
+                    # Identical file + form submissions reuse the existing result files
+                    key = cache_key(filepath, request.form)
+                    result = lookup_result(key)
+                    cached = result is not None
+                    if not cached:
+                        result = build_heatmap(filepath, request.form, timer)
+                        store_result(key, result, result_filenames(result))
+            finally:
+                # Delete the user input spreadsheet
+                os.remove(filepath)
+        ok = True
+    except HeatmapError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    finally:
+        record_request("zipcode", timer.timings, rss.peak, ok=ok, cached=cached)
+
+    # Return the link to the user
+    return jsonify({**result, "cached": cached})
+
+
+# Zipcode Heatmap Generation Project
+def result_filenames(result):
+    # Tile results have no KML, their tiles live outside the result directory
+    filenames = [
+        result[name].rsplit("/", 1)[-1]
+        for name in ("heatmap_url", "kml_url", "kmz_url")
+        if name in result
+    ]
+    # kml_url and kmz_url are the same file when KMZ was requested
+    return list(dict.fromkeys(filenames))
+
+
+# Zipcode Heatmap Generation Project
+# Runs inside a job pool process
+def run_heatmap_job(job_id, excel_path, form, timings=None, key=None):
+    def report_stage(name, timer):
+        write_job_status(
+            job_id,
+            status="running",
+            stage=name,
+            progress=timer.progress,
+            timings=timer.timings,
+        )
+
+    timer = StageTimer(on_stage=report_stage, timings=timings)
+    rss = PeakRSSSampler()
+    ok = False
+    try:
+        with rss:
+            result = build_heatmap(excel_path, form, timer)
+        if key is not None:
+            store_result(key, result, result_filenames(result))
+        write_job_status(
+            job_id,
+            status="done",
+            stage=None,
+            progress=1.0,
+            timings=timer.timings,
+            result=result,
+        )
+        ok = True
+    except Exception as e:
+        print(f"Heatmap job {job_id} failed: {e}")
+        write_job_status(job_id, status="failed", error=str(e), timings=timer.timings)
+    finally:
+        if os.path.exists(excel_path):
+            os.remove(excel_path)
+
+    # Handed back to the submitting process for its metrics window
+    return {"timings": timer.timings, "peak_rss": rss.peak, "ok": ok}
+
+
+# Zipcode Heatmap Generation Project
+def record_job_metrics(job_metrics):
+    record_request(
+        "jobs", job_metrics["timings"], job_metrics["peak_rss"], ok=job_metrics["ok"]
+    )
+
+
+# Zipcode Heatmap Generation Project
+def job_status_url(job_id):
+    return f"{os.getenv('base_url_flask')}/heatmap/jobs/{job_id}"
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/jobs", methods=["POST"])
+def create_heatmap_job():
+    try:
+        file = validate_heatmap_request(request.files, request.form)
+    except HeatmapError as e:
+        return jsonify({"error": str(e)}), e.status_code
+
+    timer = StageTimer()
+    with timer.stage("upload"):
+        filepath = save_upload(file)
+
+    job_id = new_job_id()
+    key = cache_key(filepath, request.form)
+    cached = lookup_result(key)
+    if cached is not None:
+        # Served from the result cache, the job is complete as soon as it exists
         os.remove(filepath)
+        write_job_status(
+            job_id,
+            status="done",
+            stage=None,
+            progress=1.0,
+            timings=timer.timings,
+            result={**cached, "cached": True},
+        )
+        # Same response as a queued job, the result is read from the status URL
+        return (
+            jsonify(
+                {
+                    "status": "done",
+                    "job_id": job_id,
+                    "status_url": job_status_url(job_id),
+                }
+            ),
+            202,
+        )
+
+    try:
+        submit_job(
+            job_id,
+            run_heatmap_job,
+            filepath,
+            request.form.to_dict(),
+            timer.timings,
+            key,
+            on_result=record_job_metrics,
+        )
+    except JobQueueFull as e:
+        os.remove(filepath)
+        return jsonify({"error": str(e)}), 503
 
-        # Return the link to the user
-        return jsonify(
+    return (
+        jsonify(
             {
-                "status": "success",
-                "heatmap_url": f"{os.getenv('base_url_flask')}/heatmap/result/{file_prefix}_{unique_filename}",
-                "kml_url": f"{os.getenv('base_url_flask')}/heatmap/result/{kml_filename}",
+                "status": "queued",
+                "job_id": job_id,
+                "status_url": job_status_url(job_id),
             }
-        )
-    else:
-        return jsonify({"error": "Invalid file type"}), 400
+        ),
+        202,
+    )
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/jobs/<job_id>", methods=["GET"])
+def get_heatmap_job(job_id):
+    status = read_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(status)
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/cache", methods=["GET"])
+def get_heatmap_cache_stats():
+    return jsonify(cache_stats())
+
+
+# Zipcode Heatmap Generation Project
+@heatmap_bp.route("/metrics", methods=["GET"])
+def get_heatmap_metrics():
+    return jsonify(metrics_summary())
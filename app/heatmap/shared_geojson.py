@@ -0,0 +1,145 @@
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+# Zipcode Heatmap Generation Project
+# Shared-geometry output mode. The FeatureCollection is written into the page
+# once as a JavaScript variable and every layer is built from that variable,
+# with per-feature styles read from feature properties in the browser instead
+# of folium's per-feature style switch statements.
+
+
+class SharedGeoJsonData(MacroElement):
+    """Emit a FeatureCollection once as a page-level JavaScript variable."""
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = {{ this.data|tojson }};
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, data):
+        super().__init__()
+        self._name = "SharedGeoJsonData"
+        self.data = data
+
+
+class SharedGeoJson(folium.GeoJson):
+    """
+    GeoJson layer that reads its features from a SharedGeoJsonData variable.
+    base_style applies to every feature, style_properties maps a Leaflet style
+    key to the feature property holding its value.
+    """
+
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.geoJson(null, {
+            style: function(feature) {
+                var style = Object.assign({}, {{ this.base_style|tojson }});
+                {%- for key, prop in this.style_properties.items() %}
+                style[{{ key|tojson }}] = feature.properties[{{ prop|tojson }}];
+                {%- endfor %}
+                return style;
+            },
+            {%- if this.hover_style %}
+            onEachFeature: function(feature, layer) {
+                layer.on({
+                    mouseover: function(e) {
+                        e.target.setStyle({{ this.hover_style|tojson }});
+                    },
+                    mouseout: function(e) {
+                        {{ this.get_name() }}.resetStyle(e.target);
+                    },
+                });
+            },
+            {%- endif %}
+        });
+        {{ this.get_name() }}.addData({{ this.shared.get_name() }});
+        {% endmacro %}
+        """
+    )
+
+    def __init__(
+        self, shared, base_style, style_properties, hover_style=None, **kwargs
+    ):
+        super().__init__(shared.data, **kwargs)
+        self._name = "SharedGeoJson"
+        self.shared = shared
+        self.base_style = base_style
+        self.style_properties = style_properties
+        self.hover_style = hover_style
+
+
+# Zipcode Heatmap Generation Project
+def add_shared_heatmap_layers(m, geojson_data, choropleth, style, hover_style, tooltip):
+    """
+    Add the choropleth fill, its legend and the tooltip layer to the map, all
+    drawing from a single embedded copy of geojson_data.
+    """
+    # Resolve the choropleth colors in Python once and keep them as properties
+    choropleth_style = None
+    for feature in geojson_data["features"]:
+        choropleth_style = choropleth.geojson.style_function(feature)
+        feature["properties"]["choropleth_color"] = choropleth_style["fillColor"]
+        feature["properties"]["choropleth_opacity"] = choropleth_style["fillOpacity"]
+
+    shared = SharedGeoJsonData(geojson_data)
+    m.add_child(shared)
+
+    fill_layer = SharedGeoJson(
+        shared,
+        base_style={
+            key: value
+            for key, value in (choropleth_style or {}).items()
+            if key not in ("fillColor", "fillOpacity")
+        },
+        style_properties={
+            "fillColor": "choropleth_color",
+            "fillOpacity": "choropleth_opacity",
+        },
+        name="choropleth",
+    )
+    m.add_child(fill_layer)
+    if choropleth.color_scale is not None:
+        m.add_child(choropleth.color_scale)
+
+    tooltip_layer = SharedGeoJson(
+        shared,
+        base_style=style,
+        style_properties={"fillColor": "fill_color"},
+        hover_style=hover_style,
+        control=False,
+        tooltip=tooltip,
+    )
+    m.add_child(tooltip_layer)
+    m.keep_in_front(tooltip_layer)
+    return tooltip_layer
+
+
+# Zipcode Heatmap Generation Project
+def add_metric_layers(m, geojson_data, metric_names, style, hover_style, make_tooltip):
+    """
+    Add one toggleable layer per metric, all drawing from a single embedded copy
+    of geojson_data. Metric i is colored from the fill_color_{i} property.
+    """
+    shared = SharedGeoJsonData(geojson_data)
+    m.add_child(shared)
+
+    for i, metric in enumerate(metric_names):
+        m.add_child(
+            SharedGeoJson(
+                shared,
+                base_style=style,
+                style_properties={"fillColor": f"fill_color_{i}"},
+                hover_style=hover_style,
+                name=metric,
+                overlay=True,
+                show=i == 0,
+                tooltip=make_tooltip(),
+            )
+        )
+
+    folium.LayerControl(collapsed=False).add_to(m)
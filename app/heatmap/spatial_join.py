@@ -0,0 +1,64 @@
+import numpy as np
+import shapely
+
+from .geo_store import get_state_index, state_bounds
+
+# Zipcode Heatmap Generation Project
+# Point-in-polygon assignment of lat/lon points to ZCTAs. Each state's polygons
+# get one STRtree, and every point inside the state's bounding box is matched
+# with a single vectorized query rather than a loop over points.
+
+
+class PointLocator:
+    """
+    Assigns points to ZCTAs. State bounds are read once and each state's
+    STRtree is kept for the locator's lifetime, so one locator can serve every
+    chunk of an upload without going back to the geometry cache.
+    """
+
+    def __init__(self, detail="full"):
+        self.detail = detail
+        self.bounds = state_bounds()
+        self._indexes = {}
+
+    def _index(self, state_code):
+        if state_code not in self._indexes:
+            self._indexes[state_code] = get_state_index(state_code, self.detail)
+        return self._indexes[state_code]
+
+    def locate(self, longitudes, latitudes):
+        """Return the ZCTA containing each point, None for points outside every ZCTA."""
+        longitudes = np.asarray(longitudes, dtype="float64")
+        latitudes = np.asarray(latitudes, dtype="float64")
+        zctas = np.full(len(longitudes), None, dtype=object)
+        unassigned = ~(np.isnan(longitudes) | np.isnan(latitudes))
+        points = shapely.points(longitudes, latitudes)
+
+        for state_code, (minx, miny, maxx, maxy) in self.bounds.items():
+            candidates = np.flatnonzero(
+                unassigned
+                & (longitudes >= minx)
+                & (longitudes <= maxx)
+                & (latitudes >= miny)
+                & (latitudes <= maxy)
+            )
+            if not len(candidates):
+                continue
+
+            tree, tree_zctas = self._index(state_code)
+            # Points on a shared border intersect both polygons, the first match wins
+            point_idx, polygon_idx = tree.query(
+                points[candidates], predicate="intersects"
+            )
+            point_idx, first = np.unique(point_idx, return_index=True)
+            matched = candidates[point_idx]
+            zctas[matched] = tree_zctas[polygon_idx[first]]
+            unassigned[matched] = False
+
+        return zctas
+
+
+# Zipcode Heatmap Generation Project
+def assign_points_to_zctas(longitudes, latitudes, detail="full"):
+    """Return the ZCTA containing each point, None for points outside every ZCTA."""
+    return PointLocator(detail).locate(longitudes, latitudes)
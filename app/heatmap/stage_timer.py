@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+
+# Zipcode Heatmap Generation Project
+# Named pipeline stages in the order a heatmap request runs them
+HEATMAP_STAGES = [
+    "upload",
+    "parse",
+    "zip_lookup",
+    "geometry",
+    "merge",
+    "render",
+    "kml",
+    "save",
+]
+
+
+class StageTimer:
+    """Record wall time per named stage, optionally reporting each stage as it starts."""
+
+    def __init__(self, on_stage=None, timings=None):
+        self.timings = dict(timings or {})
+        self.on_stage = on_stage
+
+    @contextmanager
+    def stage(self, name):
+        if self.on_stage is not None:
+            self.on_stage(name, self)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 4)
+
+    @property
+    def progress(self):
+        done = sum(1 for name in HEATMAP_STAGES if name in self.timings)
+        return round(done / len(HEATMAP_STAGES), 2)
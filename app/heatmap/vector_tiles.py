@@ -0,0 +1,302 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import shapely
+from jinja2 import Template
+
+try:
+    import mapbox_vector_tile
+except ImportError:  # Tile export is unavailable without it
+    mapbox_vector_tile = None
+
+# Zipcode Heatmap Generation Project
+# Vector tile export for national-scale heatmaps. The merged ZCTA frame is
+# stored once per tileset; Mapbox Vector Tiles are cut from it on first request
+# and kept in an MBTiles (SQLite) archive, so the browser only downloads the
+# polygons that are on screen.
+TILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "heatmap/tiles")
+TILE_LAYER = "zcta"
+TILE_EXTENT = 4096
+# Extra tile units kept around each tile so polygon edges don't show seams
+TILE_BUFFER = 64
+MIN_ZOOM = 0
+MAX_ZOOM = 14
+# Number of tileset sources (frame + spatial index) held in memory
+TILE_SOURCE_CACHE_SIZE = 4
+# Seconds a new tileset is kept before its viewer page must be in the result store
+TILESET_MIN_AGE = 600
+
+WEB_MERCATOR_HALF = 20037508.342789244
+
+_sources = OrderedDict()
+_sources_lock = threading.Lock()
+
+VIEWER_TEMPLATE = Template(
+    """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{{ title }}</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.js"></script>
+<style>html, body, #map { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var map = L.map("map");
+L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
+    attribution: "&copy; OpenStreetMap contributors"
+}).addTo(map);
+map.fitBounds({{ bounds|tojson }});
+
+var fields = {{ fields|tojson }};
+var styles = {};
+styles[{{ layer|tojson }}] = function(properties) {
+    return {
+        fill: true,
+        fillColor: properties.fill_color,
+        fillOpacity: 0.7,
+        color: "black",
+        weight: 1
+    };
+};
+L.vectorGrid.protobuf({{ tile_url|tojson }}, {
+    maxNativeZoom: {{ max_zoom }},
+    interactive: true,
+    vectorTileLayerStyles: styles
+}).on("click", function(e) {
+    var properties = e.layer.properties;
+    var rows = fields.map(function(field) {
+        return "<b>" + field + "</b>: " + properties[field];
+    });
+    L.popup().setLatLng(e.latlng).setContent(rows.join("<br>")).openOn(map);
+}).addTo(map);
+</script>
+</body>
+</html>
+"""
+)
+
+
+class TileSource:
+    """A tileset's features in web mercator with an STRtree over their geometry."""
+
+    def __init__(self, gdf):
+        self.geometries = gdf.geometry.values
+        self.properties = pd.DataFrame(gdf.drop(columns="geometry")).to_dict("records")
+        self.tree = shapely.STRtree(self.geometries)
+
+
+def _source_path(tileset_id):
+    return os.path.join(TILES_DIR, f"{tileset_id}.pkl")
+
+
+def _archive_path(tileset_id):
+    return os.path.join(TILES_DIR, f"{tileset_id}.mbtiles")
+
+
+def tileset_exists(tileset_id):
+    return tileset_id.isalnum() and os.path.exists(_archive_path(tileset_id))
+
+
+def tile_bounds(z, x, y):
+    """Web mercator bounds (minx, miny, maxx, maxy) of an XYZ tile."""
+    size = 2 * WEB_MERCATOR_HALF / 2**z
+    minx = -WEB_MERCATOR_HALF + x * size
+    maxy = WEB_MERCATOR_HALF - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def export_tileset(geo_df, property_columns, viewer_filename):
+    """
+    Store geo_df for tiling and create its empty tile archive. The tileset is
+    deleted by sweep_tilesets once viewer_filename leaves the result store.
+    Returns the tileset id.
+    """
+    if mapbox_vector_tile is None:
+        raise RuntimeError("mapbox_vector_tile is required for tile export")
+
+    tileset_id = uuid.uuid4().hex
+    os.makedirs(TILES_DIR, exist_ok=True)
+    geo_df[property_columns + ["geometry"]].to_crs(epsg=3857).to_pickle(
+        _source_path(tileset_id)
+    )
+
+    minx, miny, maxx, maxy = geo_df.total_bounds
+    conn = sqlite3.connect(_archive_path(tileset_id))
+    try:
+        conn.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        conn.execute(
+            """
+            CREATE TABLE tiles (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                tile_data BLOB,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            )
+            """
+        )
+        conn.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?)",
+            [
+                ("name", tileset_id),
+                ("format", "pbf"),
+                ("minzoom", str(MIN_ZOOM)),
+                ("maxzoom", str(MAX_ZOOM)),
+                ("bounds", f"{minx},{miny},{maxx},{maxy}"),
+                ("viewer", viewer_filename),
+            ],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return tileset_id
+
+
+def delete_tileset(tileset_id):
+    with _sources_lock:
+        _sources.pop(tileset_id, None)
+    for path in (_source_path(tileset_id), _archive_path(tileset_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _tileset_viewer(tileset_id):
+    try:
+        conn = sqlite3.connect(_archive_path(tileset_id))
+        try:
+            row = conn.execute(
+                "SELECT value FROM metadata WHERE name = 'viewer'"
+            ).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row is not None else None
+
+
+def sweep_tilesets(store, now=None):
+    """
+    Delete tilesets whose viewer page expired or was evicted from store.
+    Tilesets without a recorded viewer expire after the store's TTL.
+    Returns the number removed.
+    """
+    if not os.path.isdir(TILES_DIR):
+        return 0
+    now = now or time.time()
+
+    ages = {}
+    for entry in os.scandir(TILES_DIR):
+        tileset_id, extension = os.path.splitext(entry.name)
+        if extension in (".pkl", ".mbtiles") and tileset_id.isalnum():
+            age = now - entry.stat().st_mtime
+            ages[tileset_id] = min(age, ages.get(tileset_id, age))
+
+    removed = 0
+    for tileset_id, age in ages.items():
+        # Skip exports whose viewer may not be stored yet
+        if age < TILESET_MIN_AGE:
+            continue
+        viewer = _tileset_viewer(tileset_id) if tileset_exists(tileset_id) else None
+        if viewer is not None:
+            expired = store.metadata(viewer) is None
+        else:
+            expired = age >= store.ttl
+        if expired:
+            delete_tileset(tileset_id)
+            removed += 1
+    return removed
+
+
+def write_viewer(path, tileset_id, tile_url, fields, bounds, title="Heatmap"):
+    """Write the Leaflet viewer page for a tileset."""
+    minx, miny, maxx, maxy = bounds
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            VIEWER_TEMPLATE.render(
+                title=title,
+                tile_url=tile_url,
+                layer=TILE_LAYER,
+                fields=fields,
+                bounds=[[miny, minx], [maxy, maxx]],
+                max_zoom=MAX_ZOOM,
+            )
+        )
+
+
+def _get_source(tileset_id):
+    with _sources_lock:
+        if tileset_id in _sources:
+            _sources.move_to_end(tileset_id)
+            return _sources[tileset_id]
+
+    source = TileSource(pd.read_pickle(_source_path(tileset_id)))
+
+    with _sources_lock:
+        _sources[tileset_id] = source
+        while len(_sources) > TILE_SOURCE_CACHE_SIZE:
+            _sources.popitem(last=False)
+    return source
+
+
+def render_tile(source, z, x, y):
+    bounds = tile_bounds(z, x, y)
+    pad = (bounds[2] - bounds[0]) * TILE_BUFFER / TILE_EXTENT
+    padded = (bounds[0] - pad, bounds[1] - pad, bounds[2] + pad, bounds[3] + pad)
+
+    matches = source.tree.query(shapely.box(*padded), predicate="intersects")
+    if not len(matches):
+        return b""
+
+    # Clip to the tile and drop detail finer than one tile unit
+    geometries = shapely.clip_by_rect(source.geometries[matches], *padded)
+    geometries = shapely.simplify(
+        geometries, (bounds[2] - bounds[0]) / TILE_EXTENT, preserve_topology=True
+    )
+    features = [
+        {"geometry": geometry, "properties": source.properties[i]}
+        for i, geometry in zip(matches, geometries)
+        if not geometry.is_empty
+    ]
+    if not features:
+        return b""
+
+    return mapbox_vector_tile.encode(
+        {"name": TILE_LAYER, "features": features},
+        default_options={"quantize_bounds": bounds, "extents": TILE_EXTENT},
+    )
+
+
+def get_tile(tileset_id, z, x, y):
+    """Return the encoded tile, cutting and archiving it on first request."""
+    # MBTiles stores rows in TMS order (origin at the bottom)
+    tile_row = 2**z - 1 - y
+    conn = sqlite3.connect(_archive_path(tileset_id))
+    try:
+        row = conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, tile_row),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        data = render_tile(_get_source(tileset_id), z, x, y)
+        conn.execute(
+            "INSERT OR IGNORE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            (z, x, tile_row, sqlite3.Binary(data)),
+        )
+        conn.commit()
+        return data
+    finally:
+        conn.close()
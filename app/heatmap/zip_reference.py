@@ -0,0 +1,57 @@
+import os
+import threading
+
+import pandas as pd
+
+# Zipcode Heatmap Generation Project
+# USA zip -> state reference table. Parsed once, kept as a categorical Series
+# indexed by the integer zip code and only re-read when the CSV changes on disk.
+ZIPS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "static/USA_zip_list.csv"
+)
+
+_reference = None
+_reference_mtime = None
+_reference_lock = threading.Lock()
+
+
+def _build_reference(path):
+    us_zips = pd.read_csv(
+        path,
+        usecols=["zip_code", "state_code"],
+        dtype={"zip_code": str, "state_code": "category"},
+    )
+    zip_numbers = pd.to_numeric(us_zips["zip_code"], errors="coerce")
+    us_zips = us_zips[zip_numbers.notna()]
+
+    reference = pd.Series(
+        us_zips["state_code"].values,
+        index=pd.Index(zip_numbers.dropna().astype("int32"), name="zip_code"),
+        name="state_code",
+    )
+    # The CSV lists some zips once per MSA; the first row wins, as it did with merge
+    return reference[~reference.index.duplicated(keep="first")]
+
+
+def get_zip_reference():
+    """Return the zip -> state_code Series, reloading it if the CSV changed."""
+    global _reference, _reference_mtime
+
+    mtime = os.path.getmtime(ZIPS_DIR)
+    with _reference_lock:
+        if _reference is None or mtime != _reference_mtime:
+            _reference = _build_reference(ZIPS_DIR)
+            _reference_mtime = mtime
+        return _reference
+
+
+def lookup_state_codes(zip_codes):
+    """Map a Series of 5 digit zip strings to state codes (NaN when unknown)."""
+    reference = get_zip_reference()
+    keys = pd.to_numeric(zip_codes, errors="coerce").fillna(-1).astype("int64")
+    positions = reference.index.get_indexer(keys)
+    return pd.Series(
+        reference.array.take(positions, allow_fill=True),
+        index=zip_codes.index,
+        name="state_code",
+    )
@@ -0,0 +1,66 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Toyota Media Buy Processing Project
+# Process pool for batch media buy processing. The pool is started on the first
+# batch and kept for the life of the server, so later batches don't pay for
+# starting interpreters. Each worker parses the Nielsen calendar when it starts,
+# and a batch's files are split into one task per worker so the co-op table is
+# sent to each worker once per batch rather than once per file.
+BATCH_WORKERS = int(os.getenv("TOYOTA_BATCH_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _init_worker(load_calendar):
+    load_calendar()
+
+
+def _get_executor(load_calendar):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn starts clean interpreters rather than forking the eventlet-patched
+            # parent. They re-run the entry script as __mp_main__, which run.py
+            # checks to skip monkey_patch() and create_app().
+            _executor = ProcessPoolExecutor(
+                max_workers=BATCH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(load_calendar,),
+            )
+        return _executor
+
+
+def _run_tasks(func, load_calendar, coop_data, tasks):
+    # Cached in the worker and only re-read when the calendar workbook changes
+    nielsen_data = load_calendar()
+    return [
+        func(name, source, coop_data, nielsen_data, YC, MC)
+        for name, source, YC, MC in tasks
+    ]
+
+
+def run_batch(func, load_calendar, coop_data, tasks):
+    """
+    Return [func(name, source, coop_data, nielsen_data, YC, MC) for each task]
+    in task order, with the calls spread over the process pool. nielsen_data is
+    load_calendar() in the worker.
+    """
+    executor = _get_executor(load_calendar)
+    workers = min(BATCH_WORKERS, len(tasks))
+    # Every worker-th task, so large and small files are spread evenly
+    futures = [
+        executor.submit(_run_tasks, func, load_calendar, coop_data, tasks[i::workers])
+        for i in range(workers)
+    ]
+
+    # With eventlet's monkey patching this waits on a green lock, so other
+    # requests keep being served while the batch runs
+    results = [None] * len(tasks)
+    for i, future in enumerate(futures):
+        results[i::workers] = future.result()
+    return results
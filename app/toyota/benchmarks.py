@@ -0,0 +1,169 @@
+import io
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from openpyxl.styles import NamedStyle
+
+from . import routes
+
+# Toyota Media Buy Processing Project
+# Benchmarks for media buy processing. Run from the repository root with:
+#   python -m app.toyota.benchmarks [name ...] [--output report.json]
+# Inputs are generated, only the Nielsen calendar in toyota/files is read.
+
+# Rows in the generated media buy output
+OUTPUT_ROWS = 50_000
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _peak_memory(func, *args, **kwargs):
+    # Peak Python allocation while func runs, in bytes
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# The workbook writer as it was before the xlsxwriter path
+def _legacy_save_to_excel(toyota_data, output):
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        toyota_data.to_excel(writer, index=False)
+        wb = writer.book
+        ws = writer.sheets["Sheet1"]
+
+        currency_style = NamedStyle(name="currency", number_format="$#,##0.00")
+        wb.add_named_style(currency_style)
+
+        for row in ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=7, max_col=9):
+            for cell in row:
+                cell.style = currency_style
+    output.seek(0)
+
+
+def _media_buys(rows, seed=0):
+    """A media buy export with the columns the processing steps use."""
+    rng = np.random.default_rng(seed)
+    costs = rng.uniform(100, 50_000, rows).round(2)
+    return pd.DataFrame(
+        {
+            "Dealer Code": rng.integers(10_000, 99_999, rows),
+            "Media Name": rng.choice(["TV", "Cable", "Radio", "Digital"], rows),
+            "Budget Code": rng.choice(["Event", "TCUV", "Parts and Service"], rows),
+            "Vehicle Series Name": rng.choice(["Camry", "RAV4", "Brand"], rows),
+            "Activity Description": rng.choice(["KHOT spot", "Univision", "Local"], rows),
+            "Activity Start Date": "01-05-2024",
+            "Activity Cost": costs,
+            "Claimed Amount": costs,
+            "Invoice Amount": costs,
+            "Activity End Date": "01-25-2024",
+            "Campaign": "",
+            "Diversity": "",
+        }
+    )
+
+
+def _coop_table():
+    return pd.DataFrame(
+        {
+            "Budget Code": ["TDA2024", "PS2024", "TCUV2024"],
+            "Media Name": ["Broadcast", "Digital", "Radio/On-line Radio"],
+            "Camry": [0.5, 0.25, 0.0],
+            "RAV4": [0.3, 0.25, 0.6],
+            "Tacoma": [0.2, 0.5, 0.4],
+        }
+    )
+
+
+def bench_save_excel(rows=OUTPUT_ROWS):
+    toyota_data = _media_buys(rows)
+
+    def write(func, *args):
+        output = io.BytesIO()
+        func(toyota_data, output, *args)
+        return output.getbuffer().nbytes
+
+    report = {"rows": rows}
+    writers = {
+        "legacy_xlsx": (_legacy_save_to_excel,),
+        "xlsx": (routes.save_output, "xlsx"),
+        "csv": (routes.save_output, "csv"),
+    }
+    if routes.pyarrow is not None:
+        writers["parquet"] = (routes.save_output, "parquet")
+    for name, (func, *args) in writers.items():
+        size, seconds = _timed(write, func, *args)
+        report[name] = {
+            "seconds": round(seconds, 3),
+            "peak_mb": round(_peak_memory(write, func, *args) / 2**20, 1),
+            "bytes": size,
+        }
+    report["xlsx_speedup"] = round(
+        report["legacy_xlsx"]["seconds"] / report["xlsx"]["seconds"], 1
+    )
+    return report
+
+
+def bench_media_buy(rows=OUTPUT_ROWS, repeat=3):
+    toyota_data = _media_buys(rows)
+    coop_data = _coop_table()
+    nielsen_data, load_s = _timed(routes.load_data)
+    process_s = min(
+        _timed(
+            routes.process_media_buy,
+            toyota_data.copy(),
+            coop_data,
+            nielsen_data,
+            "2024",
+            "01",
+        )[1]
+        for _ in range(repeat)
+    )
+    return {
+        "rows": rows,
+        "calendar_load_s": round(load_s, 4),
+        "process_s": round(process_s, 4),
+    }
+
+
+BENCHMARKS = {
+    "save_excel": bench_save_excel,
+    "media_buy": bench_media_buy,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Toyota media buy benchmarks")
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+    }
+    for name in args.names:
+        print(f"Running {name}...", file=sys.stderr)
+        report[name] = BENCHMARKS[name]()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
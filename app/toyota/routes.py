@@ -1,9 +1,20 @@
 from flask import Blueprint, request, jsonify, send_file
 import pandas as pd
+import numpy as np
 import os
-from werkzeug.utils import secure_filename
+import re
+import json
+import zipfile
+import threading
 import io
-from openpyxl.styles import NamedStyle
+import xlsxwriter
+
+from .batch import run_batch
+
+try:
+    import pyarrow
+except ImportError:  # Parquet output is unavailable without it
+    pyarrow = None
 
 toyota_bp = Blueprint("toyota_bp", __name__)
 
@@ -11,6 +22,43 @@ toyota_bp = Blueprint("toyota_bp", __name__)
 from . import routes
 
 TOYOTA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "toyota/files")
+NIELSEN_CALENDAR_PATH = os.path.join(TOYOTA_DIR, "NielsenCalendar.xlsx")
+# Output format for Activity Start Date and Activity End Date
+NIELSEN_DATE_FORMAT = "%m-%d-%Y"
+
+# Batch outputs: one multi-sheet workbook, or a zip with one workbook per file
+BATCH_OUTPUTS = ("xlsx", "zip")
+# Year and month in a batch file or sheet name, e.g. "dealer_2024-05"
+BATCH_PERIOD_PATTERN = re.compile(r"(?<!\d)((?:19|20)\d{2})[-_ ]?(\d{1,2})(?!\d)")
+# Characters Excel doesn't allow in sheet names, and its length limit
+SHEET_NAME_INVALID = re.compile(r"[\[\]:*?/\\]")
+SHEET_NAME_MAX_LENGTH = 31
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Output file formats and their mimetypes
+OUTPUT_FORMATS = {
+    "xlsx": XLSX_MIMETYPE,
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Columns G to I hold amounts and are formatted as currency
+CURRENCY_COLUMNS = range(6, 9)
+CURRENCY_FORMAT = "$#,##0.00"
+# pandas' default formats for header cells and datetime cells
+HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}
+DATETIME_FORMAT = "yyyy-mm-dd hh:mm:ss"
+
+# Parsed Nielsen calendar, reloaded when the workbook's mtime changes
+_nielsen_calendar = None
+_nielsen_mtime = None
+_nielsen_lock = threading.Lock()
+
+
+# Toyota Media Buy Processing Project
+class ToyotaError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
 
 
 # Toyota Media Buy Processing Project
@@ -78,73 +126,187 @@ def update_diversity(toyota_data):
     return toyota_data
 
 
+# Toyota Media Buy Processing Project
+# Co-op allocation: each non-Brand media buy with a matching co-op row is split
+# into one row per vehicle series with a positive percentage
+def allocate_coop(toyota_data, coop_data):
+    key_cols = ["Budget Code", "Media Name"]
+
+    # Only the first co-op row for a Budget Code / Media Name pair is used
+    coop_data = coop_data.drop_duplicates(subset=key_cols, keep="first")
+    categories = [col for col in coop_data.columns if col not in key_cols]
+
+    # Long format: one (Budget Code, Media Name, category, percentage) row per share
+    shares = coop_data.melt(
+        id_vars=key_cols,
+        value_vars=categories,
+        var_name="_category",
+        value_name="_percentage",
+    )
+    shares["_percentage"] = pd.to_numeric(shares["_percentage"], errors="coerce")
+    shares["_category_order"] = shares["_category"].map(
+        {category: i for i, category in enumerate(categories)}
+    )
+
+    matched = (
+        toyota_data[key_cols]
+        .merge(coop_data[key_cols].assign(_matched=True), on=key_cols, how="left")[
+            "_matched"
+        ]
+        .fillna(False)
+        .to_numpy(dtype=bool)
+    )
+    matched &= (toyota_data["Vehicle Series Name"] != "Brand").to_numpy()
+
+    allocated = (
+        toyota_data[matched]
+        .assign(_row=np.flatnonzero(matched))
+        .merge(shares[shares["_percentage"] > 0], on=key_cols, how="inner")
+        .sort_values(["_row", "_category_order"], kind="stable")
+    )
+    allocated["Vehicle Series Name"] = allocated["_category"]
+    allocated["Claimed Amount"] = allocated["Activity Cost"] * allocated["_percentage"]
+    allocated = allocated.drop(
+        columns=["_row", "_category", "_percentage", "_category_order"]
+    )
+
+    # Buys without a co-op match (and Brand buys) stay as they are
+    return toyota_data[~matched], allocated
+
+
 # Toyota Media Buy Processing Project
 # Step 4: Modify Dates, Vehicle Series Name, and Claimed Amount
 def modify_dates_and_amounts(toyota_data, coop_data, nielsen_data, YC, MC):
-    new_rows = []
-    for index, row in toyota_data.iterrows():
-        if row["Vehicle Series Name"] != "Brand":
-            coop_matching_row = coop_data[
-                (coop_data["Budget Code"] == row["Budget Code"])
-                & (coop_data["Media Name"] == row["Media Name"])
-            ]
-
-            if not coop_matching_row.empty:
-                coop_matching_row = coop_matching_row.iloc[0]
-                for category, percentage in coop_matching_row.items():
-                    if category not in ["Budget Code", "Media Name"] and percentage > 0:
-                        new_row = row.copy()
-                        new_row["Vehicle Series Name"] = category
-                        new_row["Claimed Amount"] = row["Activity Cost"] * percentage
-                        new_rows.append(new_row)
-                toyota_data = toyota_data.drop(index)
+    toyota_data, new_rows_df = allocate_coop(toyota_data, coop_data)
 
     # Update the Activity Start Date and Activity End Date based on the Nielsen Calendar data
-    nielsen_calendar = nielsen_data[
-        (nielsen_data["Month"] == int(MC)) & (nielsen_data["Year"] == int(YC))
-    ]
-    for index, row in toyota_data.iterrows():
-        toyota_data.at[index, "Activity Start Date"] = (
-            nielsen_calendar["Start Date"].dt.strftime("%m-%d-%Y").values[0]
-        )
-        toyota_data.at[index, "Activity End Date"] = (
-            nielsen_calendar["End Date"].dt.strftime("%m-%d-%Y").values[0]
-        )
-        toyota_data.at[index, "Claimed Amount"] = toyota_data.at[index, "Activity Cost"]
-        toyota_data.at[index, "Vehicle Series Name"] = "Brand"
+    period = (int(YC), int(MC))
+    if period not in nielsen_data:
+        raise ValueError(f"No Nielsen calendar entry for {MC}/{YC}")
+    start_date, end_date = nielsen_data[period]
+    # Column-wide .loc assignment keeps the existing column dtypes, as .at did per row
+    toyota_data = toyota_data.copy()
+    toyota_data.loc[:, "Activity Start Date"] = start_date
+    toyota_data.loc[:, "Activity End Date"] = end_date
+    toyota_data.loc[:, "Claimed Amount"] = toyota_data["Activity Cost"]
+    toyota_data.loc[:, "Vehicle Series Name"] = "Brand"
 
-    new_rows_df = pd.DataFrame(new_rows)
     toyota_data = pd.concat([toyota_data, new_rows_df], ignore_index=True)
     return toyota_data
 
 
 # Toyota Media Buy Processing Project
 def save_to_excel(toyota_data, output):
-    # Step 1: Save the DataFrame to an Excel file stored in a BytesIO object
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        toyota_data.to_excel(writer, index=False)
-        wb = writer.book
-        ws = writer.sheets["Sheet1"]
-
-        # Step 2: Apply currency formatting
-        currency_style = NamedStyle(name="currency", number_format="$#,##0.00")
-        wb.add_named_style(currency_style)
-
-        for row in ws.iter_rows(
-            min_row=2, max_row=ws.max_row, min_col=7, max_col=9
-        ):  # Columns G to I
-            for cell in row:
-                cell.style = currency_style
-
-    # The workbook is saved when exiting the context manager
+    save_sheets_to_excel({"Sheet1": toyota_data}, output)
+
+
+# Toyota Media Buy Processing Project
+def save_sheets_to_excel(sheets, output):
+    """Write each sheet name -> DataFrame in sheets to one workbook in output."""
+    # constant_memory streams each row to disk once the next one starts, so
+    # rows must be written top to bottom (pandas' to_excel writes by column)
+    wb = xlsxwriter.Workbook(
+        output,
+        {"constant_memory": True, "strings_to_urls": False, "remove_timezone": True},
+    )
+    header_format = wb.add_format(HEADER_FORMAT)
+    currency_format = wb.add_format({"num_format": CURRENCY_FORMAT})
+    datetime_format = wb.add_format({"num_format": DATETIME_FORMAT})
+
+    for sheet_name, toyota_data in sheets.items():
+        ws = wb.add_worksheet(sheet_name)
+
+        # Formats are set per column, cells written without one inherit it
+        for col, dtype in enumerate(toyota_data.dtypes):
+            if col in CURRENCY_COLUMNS:
+                ws.set_column(col, col, None, currency_format)
+            elif pd.api.types.is_datetime64_any_dtype(dtype):
+                ws.set_column(col, col, None, datetime_format)
+
+        ws.write_row(0, 0, [str(col) for col in toyota_data.columns], header_format)
+        # Object dtype turns numpy scalars into Python values and empty cells into None
+        values = toyota_data.astype(object).where(toyota_data.notna(), None)
+        for row, record in enumerate(
+            values.itertuples(index=False, name=None), start=1
+        ):
+            ws.write_row(row, 0, record)
+
+    wb.close()
+    output.seek(0)
+
+
+# Toyota Media Buy Processing Project
+def save_output(toyota_data, output, output_format="xlsx"):
+    """Write toyota_data to output as xlsx, csv or parquet."""
+    if output_format == "xlsx":
+        save_to_excel(toyota_data, output)
+        return
+    if output_format == "csv":
+        toyota_data.to_csv(output, index=False)
+    elif output_format == "parquet":
+        # Columns mixing date strings and timestamps can't be stored as one type
+        object_columns = toyota_data.select_dtypes(include="object").columns
+        toyota_data.astype({col: "string" for col in object_columns}).to_parquet(
+            output, index=False
+        )
+    else:
+        raise ValueError(f"Unsupported output format {output_format}")
     output.seek(0)
 
 
+# Toyota Media Buy Processing Project
+def validate_output_format(output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ToyotaError(f"output must be one of {', '.join(OUTPUT_FORMATS)}")
+    if output_format == "parquet" and pyarrow is None:
+        raise ToyotaError("Parquet output is not available on this server", 501)
+
+
+# Toyota Media Buy Processing Project
+# Steps 1-4 for one media buy file
+def process_media_buy(toyota_data, coop_data, nielsen_data, YC, MC):
+    toyota_data = modify_media_and_budget(toyota_data, YC, MC)
+    toyota_data = update_campaign(toyota_data, YC, MC)
+    toyota_data = update_diversity(toyota_data)
+    toyota_data = modify_dates_and_amounts(toyota_data, coop_data, nielsen_data, YC, MC)
+    return toyota_data
+
+
+# Toyota Media Buy Processing Project
+def parse_nielsen_calendar(nielsen_data):
+    """Map (Year, Month) to the formatted (start, end) dates of that Nielsen month."""
+    start_dates = nielsen_data["Start Date"].dt.strftime(NIELSEN_DATE_FORMAT)
+    end_dates = nielsen_data["End Date"].dt.strftime(NIELSEN_DATE_FORMAT)
+    calendar = {}
+    # The first row for a month wins, as with the old per-request lookup
+    for year, month, start_date, end_date in zip(
+        nielsen_data["Year"], nielsen_data["Month"], start_dates, end_dates
+    ):
+        calendar.setdefault((int(year), int(month)), (start_date, end_date))
+    return calendar
+
+
 # Toyota Media Buy Processing Project
 # Load the data
 def load_data():
-    nielsen_data = pd.read_excel(os.path.join(TOYOTA_DIR, "NielsenCalendar.xlsx"))
-    return nielsen_data
+    """Return the parsed Nielsen calendar, re-reading the workbook only when it changes."""
+    global _nielsen_calendar, _nielsen_mtime
+    mtime = os.path.getmtime(NIELSEN_CALENDAR_PATH)
+    with _nielsen_lock:
+        if _nielsen_calendar is None or _nielsen_mtime != mtime:
+            _nielsen_calendar = parse_nielsen_calendar(
+                pd.read_excel(NIELSEN_CALENDAR_PATH)
+            )
+            _nielsen_mtime = mtime
+        return _nielsen_calendar
+
+
+# Toyota Media Buy Processing Project
+@toyota_bp.record_once
+def preload_nielsen_calendar(state):
+    # Parse the calendar at startup so the first request doesn't pay for it
+    if os.path.exists(NIELSEN_CALENDAR_PATH):
+        load_data()
 
 
 # Toyota Media Buy Processing Project
@@ -153,57 +315,206 @@ def toyota_media_buy_processing():
     try:
         YC = request.form.get("YC")
         temp_mc = request.form.get("MC")
-        MC = f"{int(temp_mc):02d}"
+        MC = f"{int(temp_mc):02d}" if temp_mc else None
+        output_format = request.form.get("output", "xlsx")
+        validate_output_format(output_format)
 
         toyota_file = request.files.get("toyota_file")
         coop_file = request.files.get("coop_file")
 
         if toyota_file and coop_file and YC and MC:
-            toyota_filename = secure_filename(toyota_file.filename)
-            coop_filename = secure_filename(coop_file.filename)
-
-            toyota_filepath = os.path.join(TOYOTA_DIR, toyota_filename)
-            coop_filepath = os.path.join(TOYOTA_DIR, coop_filename)
-
-            toyota_file.save(toyota_filepath)
-            coop_file.save(coop_filepath)
-
+            # Parse straight from the upload streams, nothing is written to disk
+            # so concurrent requests can't collide on a shared file name
             nielsen_data = load_data()
-            toyota_data = pd.read_excel(toyota_filepath)
-            coop_data = pd.read_excel(coop_filepath).drop(
+            toyota_data = pd.read_excel(toyota_file.stream)
+            coop_data = pd.read_excel(coop_file.stream).drop(
                 columns=["Total"], errors="ignore"
             )
 
-
-
-            toyota_data = modify_media_and_budget(toyota_data, YC, MC)
-            toyota_data = update_campaign(toyota_data, YC, MC)
-            toyota_data = update_diversity(toyota_data)
-            toyota_data = modify_dates_and_amounts(
+            toyota_data = process_media_buy(
                 toyota_data, coop_data, nielsen_data, YC, MC
             )
 
-            os.remove(toyota_filepath)
-            os.remove(coop_filepath)
-
-            # file_path = "./toyota/files/toyota_data.xlsx"
-            # toyota_data.to_excel(file_path, index=False, engine="openpyxl")
-
             output = io.BytesIO()
-            save_to_excel(toyota_data, output)
+            save_output(toyota_data, output, output_format)
 
-            # Send the Excel file to the user
+            # Send the file to the user
             return send_file(
                 output,
                 as_attachment=True,
-                download_name="toyota_data.xlsx",
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                download_name=f"toyota_data.{output_format}",
+                mimetype=OUTPUT_FORMATS[output_format],
             )
         else:
             return jsonify({"error": "File Error(s)"}), 412
+    except ToyotaError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        # Log the exception for debugging
+        print(f"ERROR: {e}")
+
+        # Return a JSON response indicating an error
+        return jsonify({"error": "An error occurred", "message": str(e)}), 500
+
+
+# Toyota Media Buy Processing Project
+def read_batch_items(media_file):
+    """
+    Return [(name, source)] for a batch upload: every xlsx in a zip as raw bytes
+    (parsed one at a time while processing), or every sheet of a workbook as a
+    DataFrame.
+    """
+    filename = media_file.filename.lower()
+    if filename.endswith(".zip"):
+        items = []
+        with zipfile.ZipFile(media_file.stream) as archive:
+            for member in archive.infolist():
+                basename = os.path.basename(member.filename)
+                # Skip folders, macOS metadata and Excel lock files
+                if (
+                    member.is_dir()
+                    or member.filename.startswith("__MACOSX/")
+                    or basename.startswith(("~$", "."))
+                    or not basename.lower().endswith(".xlsx")
+                ):
+                    continue
+                items.append((os.path.splitext(basename)[0], archive.read(member)))
+        return items
+    if filename.endswith(".xlsx"):
+        return list(pd.read_excel(media_file.stream, sheet_name=None).items())
+    raise ToyotaError("media_file must be a .zip of .xlsx files or an .xlsx workbook")
+
+
+# Toyota Media Buy Processing Project
+def batch_period(name, periods, default_period):
+    """
+    Return (YC, MC) for a batch file or sheet: from the periods form field
+    ({name: "YYYY-MM"}), else a year and month in the name, else the YC/MC fields.
+    """
+    match = None
+    if name in periods:
+        match = BATCH_PERIOD_PATTERN.fullmatch(str(periods[name]).strip())
+        if match is None:
+            raise ToyotaError(f"Invalid period for {name}, expected YYYY-MM")
+    else:
+        match = BATCH_PERIOD_PATTERN.search(name)
+
+    if match is not None:
+        year, month = match.groups()
+    elif default_period is not None:
+        year, month = default_period
+    else:
+        raise ToyotaError(f"No month and year given for {name}")
+
+    if not 1 <= int(month) <= 12:
+        raise ToyotaError(f"Invalid month for {name}")
+    return str(int(year)), f"{int(month):02d}"
+
+
+# Toyota Media Buy Processing Project
+def sheet_title(name, used):
+    """A valid, unique Excel sheet name for name."""
+    base = SHEET_NAME_INVALID.sub("_", name)[:SHEET_NAME_MAX_LENGTH] or "Sheet"
+    title = base
+    suffix = 1
+    while title.lower() in used:
+        suffix += 1
+        tail = f" ({suffix})"
+        title = base[: SHEET_NAME_MAX_LENGTH - len(tail)] + tail
+    used.add(title.lower())
+    return title
+
+
+# Toyota Media Buy Processing Project
+def process_batch_item(name, source, coop_data, nielsen_data, YC, MC):
+    if isinstance(source, bytes):
+        source = pd.read_excel(io.BytesIO(source))
+    try:
+        return process_media_buy(source, coop_data, nielsen_data, YC, MC)
+    except Exception as e:
+        raise ValueError(f"{name}: {e}") from e
+
+
+# Toyota Media Buy Processing Project
+@toyota_bp.route("/media_buy_batch", methods=["POST"])
+def toyota_media_buy_batch():
+    """
+    Process many media buy files against one co-op file. media_file is a zip of
+    xlsx files or a workbook with one sheet per file; each gets its month from
+    the periods field, its name, or the YC/MC fields. With output=zip each file
+    is written in file_format (xlsx, csv or parquet).
+    """
+    try:
+        media_file = request.files.get("media_file")
+        coop_file = request.files.get("coop_file")
+        if not media_file or not coop_file:
+            return jsonify({"error": "File Error(s)"}), 412
+
+        output_format = request.form.get("output", "xlsx")
+        if output_format not in BATCH_OUTPUTS:
+            raise ToyotaError(f"output must be one of {', '.join(BATCH_OUTPUTS)}")
+        # Format of each file in a zip output
+        file_format = request.form.get("file_format", "xlsx")
+        validate_output_format(file_format)
+
+        try:
+            periods = json.loads(request.form.get("periods") or "{}")
+        except json.JSONDecodeError:
+            raise ToyotaError("periods must be a JSON object")
+        if not isinstance(periods, dict):
+            raise ToyotaError("periods must be a JSON object")
+
+        YC = request.form.get("YC")
+        temp_mc = request.form.get("MC")
+        default_period = (YC, temp_mc) if YC and temp_mc else None
+
+        items = read_batch_items(media_file)
+        if not items:
+            raise ToyotaError("media_file contains no media buy files")
+        tasks = [
+            (name, source, *batch_period(name, periods, default_period))
+            for name, source in items
+        ]
+
+        # The co-op table is parsed once for the whole batch, the files are
+        # processed in the batch pool
+        coop_data = pd.read_excel(coop_file.stream).drop(
+            columns=["Total"], errors="ignore"
+        )
+        results = run_batch(process_batch_item, load_data, coop_data, tasks)
+
+        used = set()
+        sheets = {
+            sheet_title(name, used): toyota_data
+            for (name, *_), toyota_data in zip(tasks, results)
+        }
+        output = io.BytesIO()
+        if output_format == "zip":
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+                for title, toyota_data in sheets.items():
+                    file_output = io.BytesIO()
+                    save_output(toyota_data, file_output, file_format)
+                    archive.writestr(f"{title}.{file_format}", file_output.getvalue())
+            output.seek(0)
+            return send_file(
+                output,
+                as_attachment=True,
+                download_name="toyota_batch.zip",
+                mimetype="application/zip",
+            )
+
+        save_sheets_to_excel(sheets, output)
+        return send_file(
+            output,
+            as_attachment=True,
+            download_name="toyota_batch.xlsx",
+            mimetype=XLSX_MIMETYPE,
+        )
+    except ToyotaError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
         # Log the exception for debugging
-        print("ERROR: " + e)
+        print(f"ERROR: {e}")
 
         # Return a JSON response indicating an error
         return jsonify({"error": "An error occurred", "message": str(e)}), 500
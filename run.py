@@ -1,8 +1,13 @@
-import eventlet
-eventlet.monkey_patch()
-from app import create_app, socketio
+# Job pool processes are started with spawn, which re-runs this file as
+# __mp_main__. They must not monkey patch themselves, connect to Mongo or start
+# sweepers, so the server setup is skipped in them.
+if __name__ != "__mp_main__":
+    import eventlet
 
-app = create_app()
+    eventlet.monkey_patch()
+    from app import create_app, socketio
+
+    app = create_app()
 
 if __name__ == "__main__":
     socketio.run(app, host="0.0.0.0", port=8000)